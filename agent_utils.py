@@ -1,15 +1,27 @@
 import os
 from llm_utils import *
+from knowledge_utils import get_knowledge_index
+from metrics_utils import metrics
 from datetime import datetime
-import pickle
-import numpy as np
-from sentence_transformers import SentenceTransformer
 import re
+import json
 
 global agents
 agents = []
 all_agent_names = []
 
+CONTEXT_TOKEN_BUDGET = int(os.getenv('CONTEXT_TOKEN_BUDGET', 1500))
+# room for each agent's thinking + message in a round completion
+ROUND_TOKENS_PER_AGENT = 200
+
+
+# agent names become directory names under agents/, so no slashes or leading dots
+AGENT_NAME = re.compile(r'\w[\w.-]{0,63}')
+
+
+def valid_agent_name(name):
+  return isinstance(name, str) and AGENT_NAME.fullmatch(name) is not None
+
 
 def format_agent_message(author, content):
   return f"**{author}**: {content}"
@@ -24,22 +36,86 @@ def unformat_agent_message(message):
   return None, message
 
 
+class ResponseStream:
+  # incremental view of a streamed reply: hides <thinking> as it arrives and
+  # decides "[null]" vs speaking as soon as the visible answer starts
+  def __init__(self, chunks, agent):
+    self.chunks = chunks
+    self.agent = agent
+    self.raw = ""
+    self.finished = False
+
+
+  def visible(self):
+    text = re.sub(r'<thinking>.*?</thinking>', '', self.raw, flags=re.DOTALL)
+    if '<thinking>' in text:
+      text = text[:text.index('<thinking>')]
+    # hold back a tag that's only half arrived
+    for i in range(1, len('<thinking>')):
+      if text.endswith('<thinking>'[:i]):
+        text = text[:-i]
+        break
+    return text.lstrip()
+
+
+  def decision(self):
+    text = self.visible()
+    if "[null]" in text:
+      return "null"
+    if not text or "[null]".startswith(text):
+      return None if not self.finished else "null"
+    return "speak"
+
+
+  async def _next(self):
+    try:
+      self.raw += await self.chunks.__anext__()
+    except StopAsyncIteration:
+      self.finished = True
+
+
+  async def decide(self):
+    while self.decision() is None and not self.finished:
+      await self._next()
+    decision = self.decision()
+    if decision == "null":
+      await self.close()
+    return decision
+
+
+  async def updates(self):
+    while not self.finished:
+      await self._next()
+      yield self.visible()
+
+
+  def text(self):
+    # same cleanup as the non-streaming path, prints the thinking too
+    return self.agent._parse_response(self.raw)
+
+
+  async def close(self):
+    self.finished = True
+    await self.chunks.aclose()
+
+
 class Agent:
   def __init__(self, name, bot):
     self.bot = bot
     self.name = name
     self.messages = []
     self.agent_dir = f'agents/{name}'
-    self.prompt_file = f'{self.agent_dir}/prompt.txt'
-    self.scratch_memory_file = f'{self.agent_dir}/memory/scratch.txt'
+    self.memory = bot.state.memory_store(name)
+    self.knowledge = get_knowledge_index(self.agent_dir)
+    self.context_token_budget = CONTEXT_TOKEN_BUDGET
+    self._context_memo = {}
     os.makedirs(self.agent_dir, exist_ok=True)
 
 
   def get_system_prompt(self):
-    with open(self.prompt_file, 'r') as file:
-      prompt = file.read()
+    prompt = self.bot.state.prompt(self.name)
     
-    # scratch_memory = open(self.scratch_memory_file, 'r').read()
+    # scratch_memory = "\n".join(self.bot.state.scratch(self.name))
     # if scratch_memory:
     #   prompt += f"\n\nRecent memories:\n{scratch_memory}"
 
@@ -51,57 +127,45 @@ class Agent:
 
 
   def add_scratch_memory(self, memory):
-    with open(self.scratch_memory_file, 'a') as file:
-      file.write(f"{memory}\n")
+    self.bot.state.add_scratch(self.name, memory)
+    # consolidates in the background once scratch passes the threshold
+    self.bot.consolidator.maybe_request(self.name)
 
 
   def scratch_to_ltm(self):
-    with open(self.scratch_memory_file, 'r') as file:
-      scratch_memory = file.read()
-    
-    summary_prompt = f"Summarize the following recent memories into a concise, meaningful summary:\n\n{scratch_memory}"
-    summary = simple_completion_claude(summary_prompt, max_tokens=100)
-    summary_embedding = get_embedding(summary)
-
-    embeddings = np.load(f"{self.agent_dir}/embeddings.npy")
-    memories = pickle.load(f)
-    
-    embeddings = np.vstack((embeddings, summary_embedding))
-    memories.append((datetime.now().isoformat(), summary))
-    
-    np.save(f"{self.agent_dir}/memory/embeddings.npy", embeddings)
-    with open(f"{self.agent_dir}/memory/memory.pkl", 'wb') as f:
-      pickle.dump(memories, f)
-    
-    open(self.scratch_memory_file, 'w').close()
+    # summarizing + embedding happens on the consolidation worker, not here
+    self.bot.consolidator.request(self.name)
 
 
-  def get_ltm(self):
-    with open(f"{self.agent_dir}/memory/memory.pkl", 'rb') as file:
-      long_term_memories = pickle.load(file)
-    
-    if not long_term_memories:
+  def get_ltm(self, top_k=3):
+    if len(self.memory) == 0:
       return ""
     
     current_context = "\n".join([msg['content'] for msg in self.messages[-10:]])
     current_embedding = get_embedding(current_context)
     
-    memory_embeddings = [get_embedding(memory) for memory in long_term_memories]
-    similarities = [cosine_similarity(current_embedding, mem_embedding) for mem_embedding in memory_embeddings]
-    
-    top_memories = sorted(zip(long_term_memories, similarities), key=lambda x: x[1], reverse=True)[:3]
+    top_memories = self.memory.search(current_embedding, top_k=top_k)
     
     return "\n".join([memory for memory, _ in top_memories])
 
 
-  def respond(self):
-    if not self.messages:
+  async def get_ltm_async(self, top_k=3):
+    # same as get_ltm, with the embedding done off the event loop
+    if len(self.memory) == 0:
       return ""
+    current_context = "\n".join([msg['content'] for msg in self.messages[-10:]])
+    top_memories = self.memory.search(await get_embedding_async(current_context), top_k=top_k)
+    return "\n".join([memory for memory, _ in top_memories])
+
+
+  def _build_prompt(self):
+    if not self.messages:
+      return None
 
     context = self._get_context()
     if not context:
       print(f"NO CONTEXT")
-      return ""
+      return None
     
     info_prompt = f"""
       Today is {datetime.now().strftime("%m-%d")}. It is currently {datetime.now().strftime("%I:%M %p")}.
@@ -122,13 +186,20 @@ class Agent:
       
       VIPs: You should prioritize responding to VIPs, whose names are highlighted in **bold**. If a VIP changes the topic, you should go along with it.
       
-      After thinking, respond with ONLY your message (or "[null]" if you choose to send nothing), and only one message at a time. \n\nStart of message history:
+      After thinking, respond with ONLY your message (or "[null]" if you choose to send nothing), and only one message at a time.
     """
 
-    system_prompt = self.get_system_prompt()
-    full_prompt = f"{info_prompt}\n\n{task_prompt}\n\n{context}\n\nThat was the most recent message. End of message history.\n\nRespond with either your message or '[null]' if you don't want to say anything right now."
-    response = generate_completion_claude([{"role": "user", "content": full_prompt}], system_prompt)
+    # static parts first so the provider can cache the prefix across turns;
+    # only the timestamp and history below change between calls
+    system_prompt = [
+      {"type": "text", "text": self.get_system_prompt()},
+      {"type": "text", "text": task_prompt, "cache_control": {"type": "ephemeral"}},
+    ]
+    full_prompt = f"{info_prompt}\n\nStart of message history:\n\n{context}\n\nThat was the most recent message. End of message history.\n\nRespond with either your message or '[null]' if you don't want to say anything right now."
+    return [{"role": "user", "content": full_prompt}], system_prompt
 
+
+  def _parse_response(self, response):
     # Extract and print thinking content, then remove thinking tags
     thinking_content = re.findall(r'<thinking>(.*?)</thinking>', response, re.DOTALL)
     for thought in thinking_content:
@@ -137,13 +208,39 @@ class Agent:
     response = response.strip()
     
     # self.add_scratch_memory()
-
-    # if len(open(self.scratch_memory_file, 'r').readlines()) > 20:
-    #   self.scratch_to_ltm()
     
     return response
 
 
+  def respond(self):
+    with metrics.span('context', agent=self.name):
+      prompt = self._build_prompt()
+    if prompt is None:
+      return ""
+    messages, system_prompt = prompt
+    response = generate_completion_claude(messages, system_prompt)
+    return self._parse_response(response)
+
+
+  async def respond_async(self):
+    with metrics.span('context', agent=self.name):
+      prompt = self._build_prompt()
+    if prompt is None:
+      return ""
+    messages, system_prompt = prompt
+    response = await generate_completion_claude_async(messages, system_prompt)
+    return self._parse_response(response)
+
+
+  async def respond_stream(self):
+    with metrics.span('context', agent=self.name):
+      prompt = self._build_prompt()
+    if prompt is None:
+      return None
+    messages, system_prompt = prompt
+    return ResponseStream(stream_completion_claude_async(messages, system_prompt), self)
+
+
   def add_message(self, author, content):
     if isinstance(author, str) and isinstance(content, str):
       parsed_author, parsed_content = unformat_agent_message(content)
@@ -154,7 +251,7 @@ class Agent:
   
 
   def _unformat_message(self, response):
-    users = {str(member.id): member.display_name for guild in self.bot.guilds for member in guild.members}
+    users = self.bot.guild_index.names_by_id
   
     words = response.split()
     for i, word in enumerate(words):
@@ -176,21 +273,36 @@ class Agent:
     return " ".join(words)
 
 
+  def _format_context_line(self, author, content, is_vip):
+    content = self._unformat_message(content)
+    if is_vip:
+      formatted_message = f"**{author}**: {content}"
+    else:
+      formatted_message = f"{author}: {content}"
+    return formatted_message, count_tokens(formatted_message)
+
+
   def _get_context(self):
-    with open('configs/vips.txt', 'r') as f:
-      vips = f.read().splitlines()
+    vips = set(self.bot.state.vips())
+    index_version = self.bot.guild_index.version
+    # newest first until the token budget runs out; lines formatted last turn
+    # are reused as-is, so normally only the new messages get formatted
+    memo = {}
     formatted_messages = []
-    for msg in self.messages:
+    used_tokens = 0
+    for msg in reversed(self.messages):
       if 'author' in msg and 'content' in msg:
         author = msg['author']
-        content = msg['content']
-        msg_content = msg['content']
-        content = self._unformat_message(msg_content)
-        if author in vips:
-          formatted_message = f"**{author}**: {content}"
-        else:
-          formatted_message = f"{author}: {content}"
+        key = (author, msg['content'], author in vips, index_version)
+        entry = self._context_memo.get(key) or self._format_context_line(author, msg['content'], author in vips)
+        memo[key] = entry
+        formatted_message, tokens = entry
+        if formatted_messages and used_tokens + tokens > self.context_token_budget:
+          break
+        used_tokens += tokens
         formatted_messages.append(formatted_message)
+    self._context_memo = memo
+    formatted_messages.reverse()
 
     # debug_file_path = f'debug/{self.name}_context.txt'
     # os.makedirs(os.path.dirname(debug_file_path), exist_ok=True)
@@ -208,23 +320,112 @@ class Agent:
     return author, content
   
 
-  def retrieve_knowledge(self, query, top_k=2):    
-    # load embeddings
-    embeddings = np.load(f"agents/{self.name}/embeddings.npy", allow_pickle=True)
-    with open(f"agents/{self.name}/paragraphs.pkl", 'rb') as f:
-      paragraphs = pickle.load(f)
+  def retrieve_knowledge(self, query, top_k=2):
+    return self.knowledge.retrieve(get_embedding(query), top_k)[0]
+
+
+  async def retrieve_knowledge_async(self, query, top_k=2):
+    return self.knowledge.retrieve(await get_embedding_async(query), top_k)[0]
+
+
+def retrieve_knowledge_batch(agents, queries, top_k=2):
+  # one encode for every query, then one scoring pass per distinct index
+  return _retrieve_batch(agents, get_embeddings(queries), top_k)
+
+
+async def retrieve_knowledge_batch_async(agents, queries, top_k=2):
+  return _retrieve_batch(agents, await get_embeddings_async(queries), top_k)
 
-    query_embedding = get_embedding(query)
-    similarities = np.dot(embeddings, query_embedding.T).flatten()
-    top_k_indices = np.argpartition(similarities, -top_k)[-top_k:]
-    top_k_indices = top_k_indices[np.argsort(similarities[top_k_indices])][::-1]
 
-    SCORE_THRESHOLD = 0.3
+def _retrieve_batch(agents, query_embeddings, top_k):
+  by_index = {}
+  for i, agent in enumerate(agents):
+    by_index.setdefault(id(agent.knowledge), (agent.knowledge, []))[1].append(i)
 
-    results = [paragraphs[i][1] for i in top_k_indices if similarities[i] > SCORE_THRESHOLD]
-    # similarity_scores = [similarities[i] for i in top_k_indices if similarities[i] > SCORE_THRESHOLD]
-    result_str = '\n'.join(results)
-    return result_str
+  results = [""] * len(agents)
+  for index, positions in by_index.values():
+    for position, result in zip(positions, index.retrieve(query_embeddings[positions], top_k)):
+      results[position] = result
+  return results
+
+
+ROUND_TASK_PROMPT = """
+      You're writing for several people in a discord server at once. Each of them is described above between <persona name="..."> tags, and each one decides for themselves, in character, whether to say something right now.
+
+      Thinking:
+      Each person has free will and can choose to either speak, or not speak -- they might send nothing if they've already said something in the conversation and don't have anything new to add, or if they're waiting for someone to reply. Consider whether they've just spoken and if the conversation is getting repetitive to help decide.
+
+      Replying:
+      If someone speaks, they say something that substantially adds onto what's already said, or change the topic, without repeating what they've already said. Since they're on discord, they write short messages in a very casual, conversational tone, often using short words and abbreviations.
+
+      Pings:
+      They can ping someone by prefixing their name with an @ symbol, but not if that person was already pinged in the last 3 messages or so.
+
+      VIPs: They should prioritize responding to VIPs, whose names are highlighted in **bold**. If a VIP changes the topic, they should go along with it.
+
+      Decide for each person independently. They won't see each other's replies from this round, so don't have them react to one another.
+
+      Respond with ONLY a JSON object with one key per person, named exactly as in their persona tag, each mapping to {"thinking": "<whether they'll speak and what they'll say>", "message": "<their message>"}, with "message": null for anyone who doesn't speak.
+"""
+
+
+def _build_round_prompt(agents):
+  # one shared prompt for the whole roster: personas and instructions are
+  # static so they sit in the cached prefix, the history is sent once
+  context = agents[0]._get_context() if agents[0].messages else ""
+  if not context:
+    return None
+  # by name, not by speaking priority: the same group then always makes the
+  # same prefix and reuses its cache entry whoever got mentioned
+  roster = sorted(agents, key=lambda agent: agent.name)
+  personas = "\n\n".join(f'<persona name="{agent.name}">\n{agent.get_system_prompt()}\n</persona>' for agent in roster)
+  system_prompt = [
+    {"type": "text", "text": personas},
+    {"type": "text", "text": ROUND_TASK_PROMPT, "cache_control": {"type": "ephemeral"}},
+  ]
+  names = ", ".join(agent.name for agent in roster)
+  info_prompt = f"Today is {datetime.now().strftime('%m-%d')}. It is currently {datetime.now().strftime('%I:%M %p')}."
+  full_prompt = f"{info_prompt}\n\nStart of message history:\n\n{context}\n\nThat was the most recent message. End of message history.\n\nDecide for each of: {names}."
+  return [{"role": "user", "content": full_prompt}], system_prompt
+
+
+def parse_round_response(agents, response):
+  # name -> reply ("[null]" for silence) for every agent the model answered
+  # for properly; anyone missing or malformed is left for a per-agent retry
+  start, end = response.find('{'), response.rfind('}')
+  try:
+    decisions = json.loads(response[start:end + 1]) if start != -1 else {}
+  except json.JSONDecodeError as e:
+    print(f"round: unparseable response: {e}")
+    return {}
+  if not isinstance(decisions, dict):
+    return {}
+
+  results = {}
+  for agent in agents:
+    decision = decisions.get(agent.name)
+    # no "message" key at all is malformed, not a decision to stay quiet
+    if not isinstance(decision, dict) or "message" not in decision or not isinstance(decision["message"], (str, type(None))):
+      continue
+    if decision.get("thinking"):
+      print(f"thinking ({agent.name}): {decision['thinking']}")
+    message = (decision.get("message") or "").strip()
+    results[agent.name] = message if message and message != "[null]" else "[null]"
+  return results
+
+
+async def respond_round(agents):
+  # one completion deciding for several agents at once
+  for agent in agents[1:]:
+    agent.messages = agents[0].messages
+  with metrics.span('context'):
+    prompt = _build_round_prompt(agents)
+  if prompt is None:
+    return {}
+  messages, system_prompt = prompt
+  max_tokens = min(4096, ROUND_TOKENS_PER_AGENT * len(agents))
+  response = await generate_completion_claude_async(messages, system_prompt, max_tokens=max_tokens)
+  return parse_round_response(agents, response)
 
 
 def add_message(author, content):
@@ -0,0 +1,270 @@
+# offline load test: drives DiscordBot through a fake channel/guild/member
+# model and the real anthropic client over a mocked transport, no token or
+# network needed.
+# run from the repo root: python -m benchmarks.loadtest --agents 2,8,16 --rates 0.5,2
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import shutil
+import asyncio
+import argparse
+import tempfile
+import contextlib
+from types import SimpleNamespace
+
+from benchmarks.mock_api import MockAPI
+
+CHANNEL_ID = 1000
+GUILD_ID = 1
+
+
+# discord side
+
+class FakeUser:
+  def __init__(self, id, name, bot=False):
+    self.id = id
+    self.name = name
+    self.display_name = name
+    self.bot = bot
+    self.guild = SimpleNamespace(id=GUILD_ID)
+
+
+class FakeMessage:
+  def __init__(self, channel, id, author, content):
+    self.channel = channel
+    self.id = id
+    self.author = author
+    self.content = content
+    self.created_at = time.perf_counter()
+    # commands.Context reads this even when no command matches
+    self._state = channel.bot._connection
+
+
+  async def edit(self, content):
+    self.channel.stats["edits"] += 1
+    self.content = content
+    payload = SimpleNamespace(channel_id=self.channel.id, message_id=self.id, data={"content": content})
+    await self.channel.bot.on_raw_message_edit(payload)
+
+
+  async def delete(self):
+    self.channel.stats["deletes"] += 1
+    self.channel.messages.remove(self)
+    payload = SimpleNamespace(channel_id=self.channel.id, message_id=self.id)
+    await self.channel.bot.on_raw_message_delete(payload)
+
+
+class FakeTyping:
+  async def __aenter__(self):
+    pass
+
+  async def __aexit__(self, *exc):
+    pass
+
+
+class FakeChannel:
+  def __init__(self, bot, rest_latency):
+    self.id = CHANNEL_ID
+    self.name = "general"
+    self.bot = bot
+    self.rest_latency = rest_latency
+    self.messages = []
+    self.next_id = 1
+    self.stats = {"history_calls": 0, "sends": 0, "edits": 0, "deletes": 0}
+    self.reply_latencies = []
+    self.last_user_message_at = None
+
+
+  def post(self, author, content):
+    message = FakeMessage(self, self.next_id, author, content)
+    self.next_id += 1
+    self.messages.append(message)
+    # the gateway echoes every message back, the bot's own included
+    asyncio.create_task(self.bot.on_message(message))
+    return message
+
+
+  async def history(self, limit=100):
+    self.stats["history_calls"] += 1
+    await asyncio.sleep(self.rest_latency)
+    for message in reversed(self.messages[-limit:]):
+      yield message
+
+
+  async def send(self, content):
+    self.stats["sends"] += 1
+    await asyncio.sleep(self.rest_latency)
+    if self.last_user_message_at is not None:
+      self.reply_latencies.append(time.perf_counter() - self.last_user_message_at)
+    return self.post(self.bot.user, content)
+
+
+  def typing(self):
+    return FakeTyping()
+
+
+# llm side
+
+class FakeReplies:
+  # what the mock api answers; the requests themselves go through the real
+  # anthropic client (see mock_api), streaming included
+  def __init__(self, null_rate):
+    self.null_rate = null_rate
+
+
+  def _message(self):
+    return " ".join(random.choice(["lol", "yeah", "wait", "acorns", "ok but", "fr"]) for _ in range(12))
+
+
+  def __call__(self, body):
+    system = body.get('system')
+    names = re.findall(r'<persona name="([^"]+)">', "".join(block['text'] for block in system)) if isinstance(system, list) else []
+    if names:
+      # round completion: one json decision per agent
+      return json.dumps({
+        name: {"thinking": "hm", "message": None if random.random() < self.null_rate else self._message()}
+        for name in names
+      })
+    if random.random() < self.null_rate:
+      return "<thinking>nothing new to add</thinking>[null]"
+    return "<thinking>i should say something</thinking>" + self._message()
+
+
+# harness
+
+def percentile(values, p):
+  if not values:
+    return float('nan')
+  values = sorted(values)
+  return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+async def monitor_loop_lag(lags, interval=0.01):
+  while True:
+    start = time.perf_counter()
+    await asyncio.sleep(interval)
+    lags.append(time.perf_counter() - start - interval)
+
+
+async def run_scenario(main, n_agents, rate, duration, args):
+  import discord
+  import llm_utils
+  import conversation_utils
+  from agent_utils import Agent
+
+  fake_api = MockAPI(FakeReplies(args.null_rate), latency=args.latency, jitter=args.latency / 4, chunk_delay=0.005)
+  client = fake_api.anthropic()
+  llm_utils.async_anthropic_client = lambda: client
+  conversation_utils.ROUND_RESPONSES = args.round
+
+  bot = main.DiscordBot(command_prefix='!', intents=discord.Intents.none())
+  bot._connection.user = FakeUser(999, "agents", bot=True)
+  channel = FakeChannel(bot, args.rest_latency)
+  users = [FakeUser(100 + i, f"user{i}") for i in range(5)]
+  bot.guild_index.build([SimpleNamespace(id=GUILD_ID, members=users, emojis=[])])
+
+  conversation = bot.get_conversation(channel)
+  conversation.agents = [Agent(f"agent{i}", bot) for i in range(n_agents)]
+  # the bot's timings are meant for people typing; shrink them to fit a short run
+  scheduler = conversation.scheduler
+  for name in ('min_debounce', 'max_debounce', 'max_wait', 'min_gap', 'mean_gap'):
+    setattr(scheduler, name, getattr(scheduler, name) * args.time_scale)
+  conversation.processing_interval *= args.time_scale
+
+  # turn latency = process_message wall time, turns cut short by a newer message included
+  turn_latencies = []
+  process_message = conversation.process_message
+  async def timed_process_message(message):
+    start = time.perf_counter()
+    await process_message(message)
+    turn_latencies.append(time.perf_counter() - start)
+  conversation.process_message = timed_process_message
+
+  lags = []
+  lag_task = asyncio.create_task(monitor_loop_lag(lags))
+  user_messages = 0
+  end = time.perf_counter() + duration
+  while time.perf_counter() < end:
+    await asyncio.sleep(random.expovariate(rate))
+    channel.last_user_message_at = time.perf_counter()
+    channel.post(random.choice(users), f"message {user_messages} about acorns")
+    user_messages += 1
+
+  # let the last turn finish; agents answering each other would keep it
+  # going forever, so stop the conversation after that
+  await asyncio.sleep(scheduler.max_wait + scheduler.min_gap + args.latency * 3)
+  if conversation.processing_task:
+    conversation.processing_task.cancel()
+  lag_task.cancel()
+
+  rest_calls = channel.stats["history_calls"] + channel.stats["sends"] + channel.stats["edits"] + channel.stats["deletes"]
+  return {
+    "agents": n_agents,
+    "rate": rate,
+    "user_messages": user_messages,
+    "turns": len(turn_latencies),
+    "turn_p50": percentile(turn_latencies, 50),
+    "turn_p95": percentile(turn_latencies, 95),
+    "reply_p50": percentile(channel.reply_latencies, 50),
+    "llm_per_msg": fake_api.calls / max(1, user_messages),
+    "rest_per_msg": rest_calls / max(1, user_messages),
+    "history_calls": channel.stats["history_calls"],
+    "lag_p99_ms": percentile(lags, 99) * 1000,
+    "lag_max_ms": max(lags, default=0) * 1000,
+  }
+
+
+def print_results(results):
+  columns = ["agents", "rate", "user_messages", "turns", "turn_p50", "turn_p95", "reply_p50", "llm_per_msg", "rest_per_msg", "history_calls", "lag_p99_ms", "lag_max_ms"]
+  print("  ".join(f"{column:>13}" for column in columns))
+  for result in results:
+    print("  ".join(f"{result[column]:>13.3f}" if isinstance(result[column], float) else f"{result[column]:>13}" for column in columns))
+
+
+async def run(args):
+  repo_dir = os.getcwd()
+  agent_counts = [int(n) for n in args.agents.split(',')]
+  rates = [float(r) for r in args.rates.split(',')]
+  workspace = tempfile.mkdtemp(prefix='loadtest-')
+  try:
+    # main reads agents/ and configs/ (or STATE_DB) relative to cwd at import time
+    sys.path.insert(0, repo_dir)
+    os.chdir(workspace)
+    os.environ['GENERAL_CHANNEL_ID'] = str(CHANNEL_ID)
+    os.environ.setdefault('ANTHROPIC_API_KEY', 'loadtest')
+    import main
+    import llm_utils
+    os.makedirs('configs')
+    for i in range(max(agent_counts)):
+      await main.state.set_prompt(f'agent{i}', f"You are agent{i}, a regular in this discord server.")
+    # the bot does this in warm_up on ready; keep it out of the first scenario's loop lag
+    llm_utils.count_tokens("warm up")
+    results = []
+    for n_agents in agent_counts:
+      for rate in rates:
+        random.seed(0)
+        with contextlib.redirect_stdout(sys.stdout if args.verbose else None):
+          result = await run_scenario(main, n_agents, rate, args.duration, args)
+        results.append(result)
+    print_results(results)
+  finally:
+    os.chdir(repo_dir)
+    shutil.rmtree(workspace)
+
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description=__doc__)
+  parser.add_argument('--agents', default='2,8,16', help='comma separated agent counts')
+  parser.add_argument('--rates', default='0.5,2', help='comma separated user messages/sec')
+  parser.add_argument('--duration', type=float, default=10, help='seconds of traffic per scenario')
+  parser.add_argument('--latency', type=float, default=0.8, help='mean stub completion latency (s)')
+  parser.add_argument('--null-rate', type=float, default=0.7, help='fraction of completions that answer [null]')
+  parser.add_argument('--rest-latency', type=float, default=0.05, help='fake discord REST latency (s)')
+  parser.add_argument('--time-scale', type=float, default=0.1, help='multiplier for debounce, turn spacing and agent cooldowns')
+  parser.add_argument('--round', action='store_true', help='one completion per turn for all speaking agents')
+  parser.add_argument('--verbose', action='store_true', help='keep the bot\'s own logging')
+  asyncio.run(run(parser.parse_args()))
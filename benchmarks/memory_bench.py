@@ -0,0 +1,59 @@
+# long-term memory retrieval benchmark: old python loop vs MemoryStore.search
+# run from the repo root: python -m benchmarks.memory_bench
+
+import time
+import shutil
+import tempfile
+import numpy as np
+
+from memory_utils import MemoryStore, EMBEDDING_DIM
+
+
+def loop_search(embeddings, query, top_k=3):
+  # what get_ltm used to do, minus re-embedding every memory
+  similarities = [np.dot(query, e) / (np.linalg.norm(query) * np.linalg.norm(e)) for e in embeddings]
+  return sorted(range(len(similarities)), key=lambda i: similarities[i], reverse=True)[:top_k]
+
+
+def bench(n, queries=20, loop_limit=10_000):
+  rng = np.random.default_rng(0)
+  embeddings = rng.standard_normal((n, EMBEDDING_DIM)).astype(np.float32)
+  texts = [f"memory {i}" for i in range(n)]
+  query_embeddings = rng.standard_normal((queries, EMBEDDING_DIM)).astype(np.float32)
+
+  memory_dir = tempfile.mkdtemp()
+  try:
+    store = MemoryStore(memory_dir)
+    start = time.perf_counter()
+    store.add_many(texts, embeddings)
+    bulk_ms = (time.perf_counter() - start) * 1000
+
+    start = time.perf_counter()
+    for i in range(100):
+      store.add(f"extra {i}", embeddings[i])
+    append_ms = (time.perf_counter() - start) * 1000 / 100
+
+    # reopen so search goes through the memmap, not anything cached from the writes
+    store = MemoryStore(memory_dir)
+    len(store)
+    start = time.perf_counter()
+    for query in query_embeddings:
+      store.search(query)
+    search_ms = (time.perf_counter() - start) * 1000 / queries
+
+    loop_ms = None
+    if n <= loop_limit:
+      start = time.perf_counter()
+      for query in query_embeddings[:3]:
+        loop_search(embeddings, query)
+      loop_ms = (time.perf_counter() - start) * 1000 / 3
+  finally:
+    shutil.rmtree(memory_dir)
+
+  loop = f"{loop_ms:8.2f} ms" if loop_ms is not None else "     skipped"
+  print(f"n={n:>7}  bulk add {bulk_ms:8.1f} ms  append {append_ms:6.3f} ms  search {search_ms:6.2f} ms  python loop {loop}")
+
+
+if __name__ == '__main__':
+  for n in (10_000, 100_000):
+    bench(n)
@@ -0,0 +1,104 @@
+# anthropic and openai faked at the http transport, so the real sdk clients
+# (request building, raw responses, sse parsing, errors) run offline.
+# used by sdk_check and loadtest.
+
+import json
+import random
+import asyncio
+
+import httpx
+
+
+def _usage(body, text):
+  return len(json.dumps(body)) // 4, len(text) // 4 + 1
+
+
+def _message(body, text):
+  input_tokens, output_tokens = _usage(body, text)
+  return {
+    "id": "msg_mock", "type": "message", "role": "assistant", "model": body["model"],
+    "content": [{"type": "text", "text": text}],
+    "stop_reason": "end_turn", "stop_sequence": None,
+    "usage": {"input_tokens": input_tokens, "output_tokens": output_tokens},
+  }
+
+
+def _events(body, text, chunk_size, error):
+  input_tokens, output_tokens = _usage(body, text)
+  start = {**_message(body, ""), "stop_reason": None, "usage": {"input_tokens": input_tokens, "output_tokens": 1}}
+  yield "message_start", {"type": "message_start", "message": start}
+  yield "content_block_start", {"type": "content_block_start", "index": 0, "content_block": {"type": "text", "text": ""}}
+  chunks = [text[i:i + chunk_size] for i in range(0, len(text), chunk_size)]
+  for i, chunk in enumerate(chunks):
+    if error and i == len(chunks) // 2:
+      # what the api sends when it gets overloaded halfway through a reply
+      yield "error", {"type": "error", "error": {"type": error, "message": "mock error mid-stream"}}
+      return
+    yield "content_block_delta", {"type": "content_block_delta", "index": 0, "delta": {"type": "text_delta", "text": chunk}}
+  yield "content_block_stop", {"type": "content_block_stop", "index": 0}
+  yield "message_delta", {"type": "message_delta", "delta": {"stop_reason": "end_turn", "stop_sequence": None}, "usage": {"output_tokens": output_tokens}}
+  yield "message_stop", {"type": "message_stop"}
+
+
+def _chat_completion(body, text):
+  input_tokens, output_tokens = _usage(body, text)
+  return {
+    "id": "chatcmpl-mock", "object": "chat.completion", "created": 0, "model": body["model"],
+    "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+    "usage": {"prompt_tokens": input_tokens, "completion_tokens": output_tokens, "total_tokens": input_tokens + output_tokens},
+  }
+
+
+class MockAPI:
+  # reply(body) -> text for every request that gets through. failures is a
+  # list of status codes (or "stream:<error type>") handed out in order
+  # before requests start succeeding
+  def __init__(self, reply, latency=0, jitter=0, chunk_delay=0, chunk_size=8, failures=()):
+    self.reply = reply
+    self.latency = latency
+    self.jitter = jitter
+    self.chunk_delay = chunk_delay
+    self.chunk_size = chunk_size
+    self.failures = list(failures)
+    self.calls = 0
+    self.requests = []
+
+
+  async def handle(self, request):
+    self.calls += 1
+    body = json.loads(request.content)
+    self.requests.append((request.url.path, body))
+    if self.latency:
+      await asyncio.sleep(max(0, random.gauss(self.latency, self.jitter)))
+    failure = self.failures.pop(0) if self.failures else None
+    if isinstance(failure, int):
+      error_type = {429: "rate_limit_error", 529: "overloaded_error"}.get(failure, "invalid_request_error")
+      return httpx.Response(failure, json={"type": "error", "error": {"type": error_type, "message": "mock failure"}})
+
+    text = self.reply(body)
+    if request.url.path.endswith('/chat/completions'):
+      return httpx.Response(200, json=_chat_completion(body, text))
+    if not body.get('stream'):
+      return httpx.Response(200, json=_message(body, text))
+
+    error = failure.split(':', 1)[1] if failure else None
+    async def sse():
+      for event, data in _events(body, text, self.chunk_size, error):
+        if self.chunk_delay:
+          await asyncio.sleep(self.chunk_delay)
+        yield f"event: {event}\ndata: {json.dumps(data)}\n\n".encode('utf-8')
+    return httpx.Response(200, content=sse(), headers={"content-type": "text/event-stream"})
+
+
+  def _http_client(self):
+    return httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+
+
+  def anthropic(self):
+    from anthropic import AsyncAnthropic
+    return AsyncAnthropic(api_key="mock", max_retries=0, http_client=self._http_client())
+
+
+  def openai(self):
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key="mock", max_retries=0, http_client=self._http_client())
@@ -0,0 +1,89 @@
+# offline check that the llm layer works with the real anthropic/openai
+# clients; only the http transport is faked (see mock_api). catches the sdk
+# drifting away from what llm_utils/retry_utils expect, which stubs can't.
+# run from the repo root: python -m benchmarks.sdk_check
+
+import sys
+import asyncio
+
+import llm_utils
+from metrics_utils import metrics, current_agent
+from benchmarks.mock_api import MockAPI
+
+MESSAGES = [{"role": "user", "content": "hi"}]
+CACHED_SYSTEM = [{"type": "text", "text": "you're a guy", "cache_control": {"type": "ephemeral"}}]
+
+
+def use(anthropic, openai=None):
+  llm_utils.async_anthropic_client = lambda: anthropic.anthropic()
+  llm_utils.async_openai_client = lambda: (openai or anthropic).openai()
+  llm_utils.FAILOVER_ENABLED = openai is not None
+
+
+async def check_completion():
+  api = MockAPI(lambda body: "hello")
+  use(api)
+  assert await llm_utils.generate_completion_claude_async(MESSAGES, None) == "hello"
+
+
+async def check_cached_completion():
+  # cache_control goes through the prompt caching beta endpoint
+  api = MockAPI(lambda body: "hello")
+  use(api)
+  assert await llm_utils.generate_completion_claude_async(MESSAGES, CACHED_SYSTEM) == "hello"
+  assert api.requests[-1][1]["system"][0]["cache_control"] == {"type": "ephemeral"}
+
+
+async def check_stream():
+  api = MockAPI(lambda body: "a streamed reply, in pieces")
+  use(api)
+  current_agent.set("sdk_check")
+  before = metrics.get('tokens', agent="sdk_check", kind='output')
+  chunks = [chunk async for chunk in llm_utils.stream_completion_claude_async(MESSAGES, CACHED_SYSTEM)]
+  assert "".join(chunks) == "a streamed reply, in pieces" and len(chunks) > 1
+  assert metrics.get('tokens', agent="sdk_check", kind='output') > before
+
+
+async def check_retry():
+  api = MockAPI(lambda body: "hello", failures=[529])
+  use(api)
+  assert await llm_utils.generate_completion_claude_async(MESSAGES, None) == "hello"
+  assert api.calls == 2
+
+
+async def check_failover():
+  claude, openai = MockAPI(lambda body: "from claude", failures=[400]), MockAPI(lambda body: "from openai")
+  use(claude, openai)
+  assert await llm_utils.generate_completion_claude_async(MESSAGES, CACHED_SYSTEM) == "from openai"
+
+
+async def check_stream_error():
+  # an error event mid-stream surfaces as an exception from the generator
+  from anthropic import APIStatusError
+  api = MockAPI(lambda body: "a reply that gets cut off halfway", failures=["stream:overloaded_error"])
+  use(api)
+  try:
+    async for _ in llm_utils.stream_completion_claude_async(MESSAGES, None):
+      pass
+  except APIStatusError:
+    return
+  raise AssertionError("stream finished without raising")
+
+
+CHECKS = [check_completion, check_cached_completion, check_stream, check_retry, check_failover, check_stream_error]
+
+
+async def run():
+  failed = 0
+  for check in CHECKS:
+    try:
+      await check()
+      print(f"ok    {check.__name__}")
+    except Exception as e:
+      failed += 1
+      print(f"FAIL  {check.__name__}: {e.__class__.__name__}: {e}")
+  return failed
+
+
+if __name__ == '__main__':
+  sys.exit(1 if asyncio.run(run()) else 0)
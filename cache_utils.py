@@ -0,0 +1,154 @@
+import os
+import re
+import json
+import time
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# completion cache keyed on everything that decides the output (model,
+# system prompt, messages, sampling params), with the volatile
+# "Today is .. It is currently .." line stripped so replays still hit.
+
+VOLATILE_PATTERNS = [
+  re.compile(r'Today is \d{2}-\d{2}\. It is currently \d{1,2}:\d{2} [AP]M\.'),
+]
+
+
+def _normalize_text(text):
+  for pattern in VOLATILE_PATTERNS:
+    text = pattern.sub('', text)
+  return ' '.join(text.split())
+
+
+def _normalize_content(content):
+  if isinstance(content, str):
+    return _normalize_text(content)
+  # content blocks; cache_control doesn't change the output
+  return [_normalize_text(block.get('text', '')) for block in content]
+
+
+def completion_key(model, system, messages, **params):
+  payload = {
+    "model": model,
+    "system": _normalize_content(system) if system else None,
+    "messages": [(message['role'], _normalize_content(message['content'])) for message in messages],
+    "params": params,
+  }
+  return hashlib.sha256(json.dumps(payload, sort_keys=True).encode('utf-8')).hexdigest()
+
+
+class MemoryBackend:
+  def __init__(self, max_entries=1024):
+    self.max_entries = max_entries
+    self.entries = OrderedDict()  # key -> (expires_at, value)
+
+
+  def get(self, key):
+    entry = self.entries.get(key)
+    if entry is None:
+      return None
+    if entry[0] is not None and entry[0] < time.time():
+      del self.entries[key]
+      return None
+    self.entries.move_to_end(key)
+    return entry[1]
+
+
+  def set(self, key, value, expires_at):
+    self.entries[key] = (expires_at, value)
+    self.entries.move_to_end(key)
+    while len(self.entries) > self.max_entries:
+      self.entries.popitem(last=False)
+
+
+class SQLiteBackend:
+  def __init__(self, path, max_entries=10000):
+    self.path = path
+    self.max_entries = max_entries
+    self._db = None
+    self._lock = threading.Lock()
+
+
+  def _get_db(self):
+    if self._db is None:
+      self._db = sqlite3.connect(self.path, check_same_thread=False)
+      self._db.execute("PRAGMA journal_mode=WAL")
+      self._db.execute("CREATE TABLE IF NOT EXISTS completions (key TEXT PRIMARY KEY, value TEXT, expires_at REAL, used_at REAL)")
+      self._db.execute("CREATE INDEX IF NOT EXISTS completions_used_at ON completions (used_at)")
+    return self._db
+
+
+  def get(self, key):
+    with self._lock:
+      db = self._get_db()
+      row = db.execute("SELECT value, expires_at FROM completions WHERE key = ?", (key,)).fetchone()
+      if row is None:
+        return None
+      if row[1] is not None and row[1] < time.time():
+        db.execute("DELETE FROM completions WHERE key = ?", (key,))
+        db.commit()
+        return None
+      db.execute("UPDATE completions SET used_at = ? WHERE key = ?", (time.time(), key))
+      db.commit()
+      return row[0]
+
+
+  def set(self, key, value, expires_at):
+    with self._lock:
+      db = self._get_db()
+      now = time.time()
+      db.execute("INSERT OR REPLACE INTO completions (key, value, expires_at, used_at) VALUES (?, ?, ?, ?)", (key, value, expires_at, now))
+      db.execute("DELETE FROM completions WHERE expires_at IS NOT NULL AND expires_at < ?", (now,))
+      # least recently used go first once over size
+      db.execute("""
+        DELETE FROM completions WHERE key IN (
+          SELECT key FROM completions ORDER BY used_at DESC LIMIT -1 OFFSET ?
+        )""", (self.max_entries,))
+      db.commit()
+
+
+class CompletionCache:
+  def __init__(self, backend, ttl=None):
+    self.backend = backend
+    self.ttl = ttl
+    self.hits = 0
+    self.misses = 0
+
+
+  async def _run(self, fn, *args):
+    # sqlite goes to a thread, the in-memory dict doesn't need to
+    if isinstance(self.backend, MemoryBackend):
+      return fn(*args)
+    return await asyncio.to_thread(fn, *args)
+
+
+  async def get(self, key):
+    value = await self._run(self.backend.get, key)
+    if value is None:
+      self.misses += 1
+    else:
+      self.hits += 1
+    return value
+
+
+  async def set(self, key, value):
+    expires_at = time.time() + self.ttl if self.ttl else None
+    await self._run(self.backend.set, key, value, expires_at)
+
+
+  def stats(self):
+    return {"hits": self.hits, "misses": self.misses}
+
+
+def make_completion_cache():
+  kind = os.getenv('COMPLETION_CACHE', 'off')
+  ttl = float(os.getenv('COMPLETION_CACHE_TTL', 0)) or None
+  max_entries = int(os.getenv('COMPLETION_CACHE_SIZE', 1024))
+  if kind == 'memory':
+    return CompletionCache(MemoryBackend(max_entries), ttl)
+  if kind == 'sqlite':
+    return CompletionCache(SQLiteBackend(os.getenv('COMPLETION_CACHE_PATH', 'completion_cache.db'), max_entries), ttl)
+  return None
@@ -0,0 +1,89 @@
+import os
+import asyncio
+import tempfile
+
+# in-process cache for the small config/prompt files. files are read once and
+# only reloaded when their mtime changes; watch() polls in a thread so the
+# event loop never touches the disk on the hot path.
+
+class ConfigStore:
+  def __init__(self, poll_interval=2):
+    self.poll_interval = poll_interval
+    self._files = {}  # path -> (stamp, text)
+    self._locks = {}
+
+
+  def _stamp(self, path):
+    try:
+      stat = os.stat(path)
+      return (stat.st_mtime_ns, stat.st_size)
+    except FileNotFoundError:
+      return None
+
+
+  def _load(self, path):
+    stamp = self._stamp(path)
+    text = None
+    if stamp is not None:
+      with open(path, 'r') as file:
+        text = file.read()
+    self._files[path] = (stamp, text)
+    return text
+
+
+  def read(self, path, default=None):
+    if path in self._files:
+      text = self._files[path][1]
+    else:
+      text = self._load(path)
+    return default if text is None else text
+
+
+  def lines(self, path):
+    return [line.strip() for line in self.read(path, '').splitlines() if line.strip()]
+
+
+  def refresh(self):
+    changed = []
+    for path, (stamp, _) in list(self._files.items()):
+      if self._stamp(path) != stamp:
+        self._load(path)
+        changed.append(path)
+    return changed
+
+
+  async def watch(self):
+    while True:
+      changed = await asyncio.to_thread(self.refresh)
+      if changed:
+        print(f"reloaded config: {changed}")
+      await asyncio.sleep(self.poll_interval)
+
+
+  def _write_atomic(self, path, text):
+    directory = os.path.dirname(path) or '.'
+    os.makedirs(directory, exist_ok=True)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.tmp-')
+    try:
+      with os.fdopen(fd, 'w') as file:
+        file.write(text)
+      os.replace(tmp_path, path)
+    except BaseException:
+      os.unlink(tmp_path)
+      raise
+    self._files[path] = (self._stamp(path), text)
+
+
+  async def write(self, path, text):
+    # serialize writers per file so the last write wins in call order
+    lock = self._locks.setdefault(path, asyncio.Lock())
+    async with lock:
+      self._files[path] = (self._files.get(path, (None, None))[0], text)
+      await asyncio.to_thread(self._write_atomic, path, text)
+
+
+  async def write_lines(self, path, lines):
+    await self.write(path, ''.join(f"{line}\n" for line in lines))
+
+
+config = ConfigStore()
@@ -0,0 +1,135 @@
+import os
+import json
+import time
+import asyncio
+
+from llm_utils import generate_completion_claude_async, get_embeddings_async
+from metrics_utils import metrics, current_agent
+
+# scratch -> long-term memory, off the chat path. agents only ask for a
+# consolidation; repeated asks coalesce, the worker waits for a quiet moment,
+# summarizes a batch of agents in one completion, embeds the summaries in one
+# call, then publishes each agent's memory and trims its scratch together.
+
+SCRATCH_THRESHOLD = int(os.getenv('SCRATCH_THRESHOLD', 20))
+
+
+def summary_prompt(scratch_memory):
+  return f"Summarize the following recent memories into a concise, meaningful summary:\n\n{scratch_memory}"
+
+
+def batch_summary_prompt(scratches):
+  sections = "\n\n".join(f'<memories name="{agent}">\n{text}\n</memories>' for agent, text in scratches.items())
+  return f"""Below are recent memories for several people, each between <memories name="..."> tags.
+
+{sections}
+
+For each person, summarize their recent memories into a concise, meaningful summary. Respond with ONLY a JSON object with one key per person, named exactly as in their tag, each mapping to their summary as a string."""
+
+
+def parse_batch_summaries(agents, response):
+  start, end = response.find('{'), response.rfind('}')
+  try:
+    summaries = json.loads(response[start:end + 1]) if start != -1 else {}
+  except json.JSONDecodeError:
+    return {}
+  if not isinstance(summaries, dict):
+    return {}
+  return {agent: summaries[agent].strip() for agent in agents if isinstance(summaries.get(agent), str) and summaries[agent].strip()}
+
+
+class ConsolidationWorker:
+  def __init__(self, state, is_busy=lambda: False, threshold=SCRATCH_THRESHOLD, concurrency=1, batch_size=4, idle_poll=1, max_delay=120):
+    self.state = state
+    # true while any channel has a turn in progress; consolidation yields to chat
+    self.is_busy = is_busy
+    self.threshold = threshold
+    self.semaphore = asyncio.Semaphore(concurrency)
+    self.batch_size = batch_size
+    self.idle_poll = idle_poll
+    # a channel that's never quiet still gets consolidated eventually
+    self.max_delay = max_delay
+    self.pending = {}  # agent -> time first requested; dict keeps request order
+    self.running = set()
+    self.wake = asyncio.Event()
+
+
+  def request(self, agent):
+    if agent in self.pending or agent in self.running:
+      metrics.incr('consolidation_coalesced')
+      return
+    self.pending[agent] = time.time()
+    self.wake.set()
+
+
+  def maybe_request(self, agent):
+    if len(self.state.scratch(agent)) >= self.threshold:
+      self.request(agent)
+
+
+  async def _wait_for_idle(self):
+    oldest = min(self.pending.values())
+    while self.is_busy() and time.time() - oldest < self.max_delay:
+      await asyncio.sleep(self.idle_poll)
+
+
+  async def run(self):
+    tasks = set()
+    while True:
+      await self.wake.wait()
+      self.wake.clear()
+      while self.pending:
+        await self._wait_for_idle()
+        await self.semaphore.acquire()
+        agents = list(self.pending)[:self.batch_size]
+        for agent in agents:
+          del self.pending[agent]
+          self.running.add(agent)
+        task = asyncio.create_task(self._run_batch(agents))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+
+  async def _run_batch(self, agents):
+    try:
+      with metrics.span('consolidation'):
+        await self.consolidate(agents)
+    except Exception as e:
+      print(f"consolidation failed for {agents}: {e}")
+      metrics.incr('consolidation_errors')
+    finally:
+      self.running.difference_update(agents)
+      self.semaphore.release()
+
+
+  async def summarize(self, scratches):
+    # one completion for the batch, per-agent calls for anything it missed
+    summaries = {}
+    if len(scratches) > 1:
+      current_agent.set(list(scratches))
+      response = await generate_completion_claude_async(
+        [{"role": "user", "content": batch_summary_prompt(scratches)}], None, max_tokens=150 * len(scratches))
+      summaries = parse_batch_summaries(scratches, response)
+    for agent in scratches:
+      if agent not in summaries:
+        current_agent.set(agent)
+        summaries[agent] = await generate_completion_claude_async(
+          [{"role": "user", "content": summary_prompt(scratches[agent])}], None, max_tokens=100)
+    return summaries
+
+
+  async def consolidate(self, agents):
+    # scratch is read up front; lines added while we work are left for next time
+    lines = {agent: await asyncio.to_thread(self.state.scratch, agent) for agent in agents}
+    scratches = {agent: "\n".join(agent_lines) for agent, agent_lines in lines.items() if agent_lines}
+    if not scratches:
+      return
+    summaries = await self.summarize(scratches)
+    names = list(summaries)
+    embeddings = await get_embeddings_async([summaries[agent] for agent in names])
+
+    # each agent's memory and scratch trim are published together; see
+    # publish_memory in state_utils for what "together" means per backend
+    for agent, embedding in zip(names, embeddings):
+      await self.state.publish_memory(agent, summaries[agent], embedding, len(lines[agent]))
+      metrics.incr('consolidations', agent=agent)
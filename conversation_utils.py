@@ -0,0 +1,338 @@
+import os
+import time
+import asyncio
+
+from agent_utils import Agent, add_message, format_agent_message, unformat_agent_message, respond_round
+from llm_utils import clean_response, format_response
+from history_utils import ChannelHistory
+from metrics_utils import metrics, current_agent
+from scheduler_utils import TurnScheduler, token_budget
+
+HISTORY_LIMIT = 50
+STREAM_RESPONSES = os.getenv('STREAM_RESPONSES', '1') == '1'
+# one completion decides for every speaking agent at once; replaces streaming
+ROUND_RESPONSES = os.getenv('ROUND_RESPONSES', '0') == '1'
+# streamed replies go out once this much visible text is ready, then get edited
+STREAM_FIRST_CHUNK = 60
+STREAM_EDIT_INTERVAL = 1.0
+# a finished reply is dropped if more than this many people have posted since
+# the snapshot it was written from
+STALE_AFTER = int(os.getenv('STALE_AFTER', 3))
+
+# per-channel conversation state: roster, history buffer, cooldowns and the
+# turn scheduler. every channel runs its own pipeline; the bot only dispatches.
+
+class Conversation:
+  def __init__(self, bot, channel, agent_names, completion_semaphore, max_concurrent_responses=4):
+    self.bot = bot
+    self.channel = channel
+    self.agents = [Agent(name, bot) for name in agent_names]
+    # agents trim this down by token budget, so keep more than they'll usually use
+    self.history = ChannelHistory(limit=HISTORY_LIMIT)
+    # per-agent cooldown between replies
+    self.processing_interval = 10
+    self.scheduler = TurnScheduler()
+    self.agent_last_response = {}
+    self.processing_task = None
+    self.turn_active = False
+    # per-channel cap keeps one busy channel from taking every global slot
+    self.semaphore = asyncio.Semaphore(max_concurrent_responses)
+    self.completion_semaphore = completion_semaphore
+
+
+  async def save_roster(self):
+    await self.bot.state.set_roster(self.channel.id, [agent.name for agent in self.agents])
+
+
+  async def read_channel(self):
+    messages = await self.history.recent(self.channel, HISTORY_LIMIT)
+    return [
+      add_message(message['author'], message['content'])
+      for message in messages
+      if not message['content'].startswith('!')
+    ]
+
+
+  def on_message(self, message):
+    # a new message never cancels a turn that's already running (its
+    # completions are paid for); it just queues the next one
+    self.scheduler.note_message(message)
+    if self.processing_task is None or self.processing_task.done():
+      self.processing_task = asyncio.create_task(self.run_turns())
+
+
+  async def run_turns(self):
+    while (message := await self.scheduler.next_turn()) is not None:
+      self.turn_active = True
+      try:
+        await self.process_message(message)
+      except Exception as e:
+        # one broken turn mustn't stop the channel from taking the next
+        print(f"#{self.channel.name}: turn failed: {e!r}")
+        metrics.incr('turn_errors')
+      finally:
+        self.turn_active = False
+
+
+  def is_stale(self, agent, snapshot_id):
+    # replies are written off a snapshot; by the time one is ready the channel
+    # may have moved on. other agents' replies from this same turn don't count
+    newer = self.history.since(snapshot_id)
+    newer_authors = [unformat_agent_message(record['content'])[0] for record in newer]
+    if agent.name in newer_authors:
+      return True
+    return newer_authors.count(None) > STALE_AFTER
+
+
+  async def process_message(self, message):
+    try:
+      turn_start = time.perf_counter()
+
+      with metrics.span('history'):
+        last_two_messages = await self.history.recent(self.channel, 2)
+      message_author = message.author.display_name
+      candidates = [agent for agent in self.agents if agent.name != message_author]
+
+      # Check for mentions in the last two messages
+      mentioned_agents = [
+        agent for agent in candidates
+        if any(f"@{agent.name}" in msg['content'] for msg in last_two_messages)
+      ]
+      if len(mentioned_agents) > 0:
+        names = [agent.name for agent in mentioned_agents]
+        print(f"MENTIONED: {names}")
+
+      eligible_agents = []
+      for agent in self.scheduler.prioritize(candidates, mentioned_agents, self.agent_last_response):
+        if time.time() - self.agent_last_response.get(agent.name, 0) < self.processing_interval:
+          metrics.incr('cooldown_skips', agent=agent.name)
+        elif not token_budget.allow(agent.name):
+          metrics.incr('budget_skips', agent=agent.name)
+        else:
+          eligible_agents.append(agent)
+      if not eligible_agents:
+        return
+
+      with metrics.span('history'):
+        channel_messages = await self.read_channel()
+      snapshot_id = self.history.messages[-1]["id"] if self.history.messages else 0
+      gate = self.bot.speak_gate
+      with metrics.span('gate'):
+        speaking_agents, audited_agents = await gate.select(eligible_agents, mentioned_agents, channel_messages)
+      if not speaking_agents and not audited_agents:
+        return
+
+      round_task = None
+      # with agent workers every reply is one request/response to the agent's worker
+      sharded = self.bot.router is not None
+      if ROUND_RESPONSES and len(speaking_agents) > 1 and not sharded:
+        round_task = asyncio.create_task(self.decide_round(speaking_agents, channel_messages))
+        tasks = [
+          asyncio.create_task(self.round_response(round_task, agent, channel_messages))
+          for agent in speaking_agents
+        ]
+      elif STREAM_RESPONSES and not sharded:
+        await self.stream_responses(speaking_agents, audited_agents, channel_messages, snapshot_id)
+        metrics.observe('turn', time.perf_counter() - turn_start)
+        return
+      else:
+        # every agent decides at once off the same snapshot, capped by the semaphores
+        tasks = [
+          asyncio.create_task(self.decide_response(agent, channel_messages))
+          for agent in speaking_agents
+        ]
+      audit_tasks = [
+        asyncio.create_task(self.decide_response(agent, channel_messages))
+        for agent in audited_agents
+      ]
+
+      # post in priority order (mentioned agents first) as results come in
+      try:
+        for agent, task in zip(speaking_agents, tasks):
+          response = await task
+          gate.record(agent, response)
+          if "[null]" not in response and self.is_stale(agent, snapshot_id):
+            print(f"{agent.name}: reply went stale")
+            metrics.incr('stale_dropped', agent=agent.name)
+          elif "[null]" not in response:
+            print(f"{agent.name}: responding")
+            metrics.incr('decisions', agent=agent.name, decision='speak')
+            with metrics.span('format'):
+              response = clean_response(response, self.bot)
+              # print(f"{agent.name}: {response}")
+              formatted_response = format_response(response, self.bot)
+              formatted_response = format_agent_message(agent.name, formatted_response)
+            with metrics.span('send'):
+              await self.channel.send(formatted_response)
+            self.agent_last_response[agent.name] = time.time()
+          else:
+            print(f"{agent.name}: intent no")
+            metrics.incr('decisions', agent=agent.name, decision='null')
+
+        # gated-out agents we ran anyway, only to check the gate; never posted
+        for agent, task in zip(audited_agents, audit_tasks):
+          gate.record(agent, await task, audited=True)
+      finally:
+        for task in tasks + audit_tasks:
+          task.cancel()
+        if round_task:
+          round_task.cancel()
+      metrics.observe('turn', time.perf_counter() - turn_start)
+    except asyncio.CancelledError:
+      metrics.incr('turns_cancelled')
+
+
+  async def decide_response(self, agent, channel_messages):
+    current_agent.set(agent.name)
+    async with self.semaphore, self.completion_semaphore:
+      agent.messages = channel_messages.copy()
+      try:
+        with metrics.span('completion', agent=agent.name):
+          if self.bot.router:
+            return await self.bot.router.decide(agent.name, agent.messages, self.bot.state.vips(), self.bot.guild_index)
+          return await agent.respond_async()
+      except Exception as e:
+        print(f"{agent.name}: error responding: {e}")
+        metrics.incr('errors', agent=agent.name)
+        return "[null]"
+
+
+  async def decide_round(self, agents, channel_messages):
+    # takes one completion slot for the whole round
+    current_agent.set([agent.name for agent in agents])
+    async with self.semaphore, self.completion_semaphore:
+      agents[0].messages = channel_messages.copy()
+      try:
+        with metrics.span('round'):
+          return await respond_round(agents)
+      except Exception as e:
+        print(f"round: error responding: {e}")
+        metrics.incr('round_errors')
+        return {}
+
+
+  async def round_response(self, round_task, agent, channel_messages):
+    results = await round_task
+    if agent.name in results:
+      return results[agent.name]
+    # the round didn't produce a usable answer for this one
+    metrics.incr('round_fallbacks', agent=agent.name)
+    return await self.decide_response(agent, channel_messages)
+
+
+  async def decide_stream(self, agent, channel_messages):
+    # holds a completion slot only until the agent has decided; "[null]"
+    # aborts the stream right there
+    current_agent.set(agent.name)
+    async with self.semaphore, self.completion_semaphore:
+      agent.messages = channel_messages.copy()
+      try:
+        # time to decision; the rest of the stream is timed as delivery
+        with metrics.span('completion', agent=agent.name):
+          stream = await agent.respond_stream()
+          if stream is None or await stream.decide() == "null":
+            return None
+        return stream
+      except Exception as e:
+        print(f"{agent.name}: error responding: {e}")
+        metrics.incr('errors', agent=agent.name)
+        return None
+
+
+  async def stream_responses(self, agents, audited_agents, channel_messages, snapshot_id):
+    gate = self.bot.speak_gate
+    tasks = [asyncio.create_task(self.decide_stream(agent, channel_messages)) for agent in agents]
+    audit_tasks = [asyncio.create_task(self.decide_response(agent, channel_messages)) for agent in audited_agents]
+    delivered = set()
+    try:
+      for agent, task in zip(agents, tasks):
+        stream = await task
+        if stream is None:
+          gate.record(agent, "[null]")
+          print(f"{agent.name}: intent no")
+          metrics.incr('decisions', agent=agent.name, decision='null')
+          continue
+        if self.is_stale(agent, snapshot_id):
+          gate.record(agent, stream.visible())
+          print(f"{agent.name}: reply went stale")
+          metrics.incr('stale_dropped', agent=agent.name)
+          # stop paying for the rest of it now, not at the end of the turn
+          delivered.add(task)
+          await stream.close()
+          continue
+        print(f"{agent.name}: responding")
+        metrics.incr('decisions', agent=agent.name, decision='speak')
+        delivered.add(task)
+        # shutting down shouldn't leave a half-sent reply behind
+        with metrics.span('delivery', agent=agent.name):
+          response = await asyncio.shield(self.deliver_stream(agent, stream))
+        gate.record(agent, response)
+
+      for agent, task in zip(audited_agents, audit_tasks):
+        gate.record(agent, await task, audited=True)
+    finally:
+      for task in tasks + audit_tasks:
+        task.cancel()
+      for task in tasks:
+        if task not in delivered and task.done() and not task.cancelled() and task.result():
+          await task.result().close()
+
+
+  def _format_partial(self, agent, text):
+    with metrics.span('format'):
+      response = clean_response(text, self.bot)
+      return format_agent_message(agent.name, format_response(response, self.bot))
+
+
+  async def deliver_stream(self, agent, stream):
+    message = None
+    sent_content = None
+    last_edit = 0
+    try:
+      async with self.channel.typing():
+        async for visible in stream.updates():
+          if "[null]" in visible:
+            break
+          # only whole words, so mentions/emojis aren't formatted half-typed
+          partial = visible[:visible.rfind(' ') + 1].strip()
+          if not partial or time.time() - last_edit < STREAM_EDIT_INTERVAL:
+            continue
+          content = self._format_partial(agent, partial)
+          if message is None and len(partial) >= STREAM_FIRST_CHUNK:
+            with metrics.span('send'):
+              message = await self.channel.send(content)
+          elif message is not None and content != sent_content:
+            with metrics.span('edit'):
+              await message.edit(content=content)
+          else:
+            continue
+          sent_content = content
+          last_edit = time.time()
+    except Exception as e:
+      # an error event or dropped connection partway through: a half reply
+      # isn't worth leaving up, so take back whatever was posted
+      print(f"{agent.name}: stream failed: {e!r}")
+      metrics.incr('errors', agent=agent.name)
+      if message is not None:
+        try:
+          await message.delete()
+        except Exception as e:
+          print(f"{agent.name}: couldn't delete partial reply: {e!r}")
+      return "[null]"
+    finally:
+      await stream.close()
+
+    response = stream.text()
+    if "[null]" in response or not response:
+      if message is not None:
+        await message.delete()
+      return "[null]"
+    content = self._format_partial(agent, response)
+    if message is None:
+      with metrics.span('send'):
+        await self.channel.send(content)
+    elif content != sent_content:
+      with metrics.span('edit'):
+        await message.edit(content=content)
+    self.agent_last_response[agent.name] = time.time()
+    return response
@@ -0,0 +1,179 @@
+import os
+import asyncio
+import hashlib
+import sqlite3
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from dotenv import load_dotenv
+from startup_utils import timed
+
+load_dotenv()
+
+# embedding service: LRU cache keyed by content hash (optionally backed by a
+# sqlite file), with concurrent async requests micro-batched into one encode()
+# that runs on a worker thread instead of the event loop.
+
+
+def content_key(text):
+  return hashlib.sha256(text.encode('utf-8')).hexdigest()
+
+
+class EmbeddingService:
+  def __init__(self, model_name='all-MiniLM-L6-v2', cache_size=4096, cache_path=None, max_batch_size=64, batch_window=0.005):
+    self.model_name = model_name
+    self.cache_size = cache_size
+    self.cache_path = cache_path
+    self.max_batch_size = max_batch_size
+    self.batch_window = batch_window
+    self._model = None
+    self._cache = OrderedDict()
+    self._lock = threading.Lock()
+    self._model_lock = threading.Lock()
+    self._db = None
+    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='embeddings')
+    self._queue = []  # (key, text)
+    self._pending = {}  # key -> future
+    self._flush_task = None
+    self.hits = 0
+    self.misses = 0
+    self.batches = 0
+
+
+  def _get_model(self):
+    # torch + the model take seconds to load, so only pay for it when needed
+    if self._model is None:
+      with self._model_lock:
+        if self._model is None:
+          with timed('embedding model'):
+            from sentence_transformers import SentenceTransformer
+            self._model = SentenceTransformer(self.model_name)
+    return self._model
+
+
+  async def warm_up(self):
+    await asyncio.get_running_loop().run_in_executor(self._executor, self._get_model)
+
+
+  def _get_db(self):
+    if self._db is None and self.cache_path:
+      self._db = sqlite3.connect(self.cache_path, check_same_thread=False)
+      self._db.execute("CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, embedding BLOB)")
+    return self._db
+
+
+  def _cache_get(self, key):
+    with self._lock:
+      embedding = self._cache.get(key)
+      if embedding is not None:
+        self._cache.move_to_end(key)
+      return embedding
+
+
+  def _cache_put(self, key, embedding):
+    with self._lock:
+      self._cache[key] = embedding
+      self._cache.move_to_end(key)
+      while len(self._cache) > self.cache_size:
+        self._cache.popitem(last=False)
+
+
+  def _encode(self, items):
+    # runs on the worker thread: disk cache first, then the model for the rest
+    results = {}
+    db = self._get_db()
+    if db is not None:
+      with self._lock:
+        for key, _ in items:
+          row = db.execute("SELECT embedding FROM embeddings WHERE key = ?", (key,)).fetchone()
+          if row:
+            results[key] = np.frombuffer(row[0], dtype=np.float32)
+
+    missing = [(key, text) for key, text in items if key not in results]
+    if missing:
+      self.batches += 1
+      embeddings = self._get_model().encode([text for _, text in missing], show_progress_bar=False)
+      for (key, _), embedding in zip(missing, embeddings):
+        results[key] = np.asarray(embedding, dtype=np.float32)
+      if db is not None:
+        with self._lock:
+          db.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, embedding) VALUES (?, ?)",
+            [(key, results[key].tobytes()) for key, _ in missing])
+          db.commit()
+    return results
+
+
+  def encode(self, texts):
+    # blocking path for sync callers
+    keys = [content_key(text) for text in texts]
+    found = {key: self._cache_get(key) for key in keys}
+    missing = {key: text for key, text in zip(keys, texts) if found[key] is None}
+    self.hits += len(texts) - len(missing)
+    self.misses += len(missing)
+    if missing:
+      for key, embedding in self._encode(list(missing.items())).items():
+        self._cache_put(key, embedding)
+        found[key] = embedding
+    return np.stack([found[key] for key in keys])
+
+
+  async def embed(self, text):
+    key = content_key(text)
+    embedding = self._cache_get(key)
+    if embedding is not None:
+      self.hits += 1
+      return embedding
+    self.misses += 1
+
+    # same text already on its way, share the result
+    if key in self._pending:
+      return await asyncio.shield(self._pending[key])
+
+    future = asyncio.get_running_loop().create_future()
+    self._pending[key] = future
+    self._queue.append((key, text))
+    if len(self._queue) >= self.max_batch_size:
+      self._start_flush(0)
+    elif self._flush_task is None:
+      self._start_flush(self.batch_window)
+    return await asyncio.shield(future)
+
+
+  async def embed_many(self, texts):
+    return np.stack(await asyncio.gather(*(self.embed(text) for text in texts)))
+
+
+  def _start_flush(self, delay):
+    if self._flush_task is not None and delay > 0:
+      return
+    self._flush_task = asyncio.create_task(self._flush(delay))
+
+
+  async def _flush(self, delay):
+    if delay:
+      await asyncio.sleep(delay)
+    self._flush_task = None
+    batch, self._queue = self._queue[:self.max_batch_size], self._queue[self.max_batch_size:]
+    if self._queue:
+      self._start_flush(0)
+    if not batch:
+      return
+
+    try:
+      results = await asyncio.get_running_loop().run_in_executor(self._executor, self._encode, batch)
+    except Exception as e:
+      for key, _ in batch:
+        self._pending.pop(key).set_exception(e)
+      return
+    for key, _ in batch:
+      self._cache_put(key, results[key])
+      self._pending.pop(key).set_result(results[key])
+
+
+  def stats(self):
+    return {"hits": self.hits, "misses": self.misses, "batches": self.batches, "cached": len(self._cache)}
+
+
+embedding_service = EmbeddingService(cache_path=os.getenv('EMBEDDING_CACHE_PATH'))
@@ -0,0 +1,156 @@
+import os
+import random
+import asyncio
+import numpy as np
+
+from llm_utils import generate_completion_claude_async, get_embedding_async, CLAUDE_SMALL_MODEL
+
+# cheap "should this agent even try" stage in front of Agent.respond. a gate
+# that says no saves a full completion; a small sample of those is still run
+# through the full model (audit) so we know how often the gate is wrong.
+
+
+class SpeakGate:
+  def __init__(self, audit_rate=0.05):
+    self.audit_rate = audit_rate
+    self.stats = {}
+
+
+  def _agent_stats(self, agent):
+    return self.stats.setdefault(agent.name, {
+      "evaluated": 0, "passed": 0, "skipped": 0,
+      "passed_null": 0, "audited": 0, "audit_spoke": 0,
+    })
+
+
+  async def should_speak(self, agent, messages):
+    return True
+
+
+  async def select(self, agents, mentioned_agents, messages):
+    # returns (agents to run for real, skipped agents to audit), order kept
+    decisions = await asyncio.gather(*(
+      self._always_true() if agent in mentioned_agents else self.should_speak(agent, messages)
+      for agent in agents
+    ))
+    speaking, audited = [], []
+    for agent, decision in zip(agents, decisions):
+      stats = self._agent_stats(agent)
+      stats["evaluated"] += 1
+      if decision:
+        stats["passed"] += 1
+        speaking.append(agent)
+      else:
+        stats["skipped"] += 1
+        if random.random() < self.audit_rate:
+          audited.append(agent)
+    return speaking, audited
+
+
+  async def _always_true(self):
+    return True
+
+
+  def record(self, agent, response, audited=False):
+    stats = self._agent_stats(agent)
+    spoke = "[null]" not in response
+    if audited:
+      stats["audited"] += 1
+      stats["audit_spoke"] += spoke
+    elif not spoke:
+      stats["passed_null"] += 1
+
+
+  def summary(self):
+    totals = {}
+    for stats in self.stats.values():
+      for key, value in stats.items():
+        totals[key] = totals.get(key, 0) + value
+    if not totals:
+      return totals
+    totals["completions_saved"] = totals["skipped"] - totals["audited"]
+    # skipped agents the full model would have let speak / passed agents that said [null]
+    totals["false_skip_rate"] = totals["audit_spoke"] / totals["audited"] if totals["audited"] else None
+    totals["false_pass_rate"] = totals["passed_null"] / totals["passed"] if totals["passed"] else None
+    return totals
+
+
+class HeuristicGate(SpeakGate):
+  # recency of the agent's own last message + embedding similarity between
+  # the recent conversation and the agent's prompt. recency alone is never
+  # enough: below min_relevance the conversation has nothing to do with the
+  # agent, however long it's been quiet
+  def __init__(self, threshold=0.35, recency_weight=0.5, relevance_weight=0.5, min_relevance=0.2, recency_window=5, relevance_scale=0.5, **kwargs):
+    super().__init__(**kwargs)
+    self.threshold = threshold
+    self.recency_weight = recency_weight
+    self.relevance_weight = relevance_weight
+    self.min_relevance = min_relevance
+    self.recency_window = recency_window
+    self.relevance_scale = relevance_scale
+
+
+  def recency_score(self, agent, messages):
+    for distance, message in enumerate(reversed(messages)):
+      if message['author'] == agent.name:
+        return min(1.0, distance / self.recency_window)
+    return 1.0
+
+
+  async def relevance_score(self, agent, messages):
+    recent = "\n".join(message['content'] for message in messages[-5:])
+    if not recent:
+      return 0.0
+    prompt_embedding = await get_embedding_async(agent.get_system_prompt() or agent.name)
+    context_embedding = await get_embedding_async(recent)
+    similarity = float(np.dot(prompt_embedding[0], context_embedding[0]) / (np.linalg.norm(prompt_embedding) * np.linalg.norm(context_embedding)))
+    return min(1.0, max(0.0, similarity / self.relevance_scale))
+
+
+  async def should_speak(self, agent, messages):
+    recency = self.recency_score(agent, messages)
+    if recency == 0:
+      # had the last word, let someone else go
+      return False
+    try:
+      relevance = await self.relevance_score(agent, messages)
+    except Exception as e:
+      print(f"{agent.name}: gate error, letting through: {e}")
+      return True
+    if relevance < self.min_relevance:
+      return False
+    return self.recency_weight * recency + self.relevance_weight * relevance >= self.threshold
+
+
+class ModelGate(SpeakGate):
+  # one-token yes/no from a small model
+  def __init__(self, model=CLAUDE_SMALL_MODEL, **kwargs):
+    super().__init__(**kwargs)
+    self.model = model
+
+
+  async def should_speak(self, agent, messages):
+    history = "\n".join(f"{message['author']}: {message['content']}" for message in messages[-10:])
+    prompt = f"""Here is a discord conversation:\n\n{history}\n\n{agent.name} is a participant described as:\n{agent.get_system_prompt() or ''}\n\nWould {agent.name} plausibly want to send a message right now, given what they've already said and whether the conversation involves them? Answer with only Y or N."""
+    try:
+      answer = await generate_completion_claude_async([{"role": "user", "content": prompt}], "You are a concise classifier.", temperature=0, max_tokens=1, model=self.model)
+    except Exception as e:
+      print(f"{agent.name}: gate error, letting through: {e}")
+      return True
+    return not answer.strip().upper().startswith('N')
+
+
+def make_gate(kind=None, audit_rate=None):
+  kind = kind or os.getenv('SPEAK_GATE', 'none')
+  audit_rate = float(os.getenv('SPEAK_GATE_AUDIT_RATE', 0.05)) if audit_rate is None else audit_rate
+  if kind == 'heuristic':
+    return HeuristicGate(
+      audit_rate=audit_rate,
+      threshold=float(os.getenv('SPEAK_GATE_THRESHOLD', 0.35)),
+      recency_weight=float(os.getenv('SPEAK_GATE_RECENCY_WEIGHT', 0.5)),
+      relevance_weight=float(os.getenv('SPEAK_GATE_RELEVANCE_WEIGHT', 0.5)),
+      min_relevance=float(os.getenv('SPEAK_GATE_MIN_RELEVANCE', 0.2)),
+    )
+  if kind == 'model':
+    return ModelGate(audit_rate=audit_rate)
+  return SpeakGate(audit_rate=0)
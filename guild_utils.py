@@ -0,0 +1,57 @@
+# member/emoji lookups for formatting, built once on ready and kept current
+# from gateway events instead of rescanning every guild per message.
+
+class GuildIndex:
+  def __init__(self):
+    self.users_by_name = {}
+    self.names_by_id = {}
+    self.emojis_by_name = {}
+    # (guild id, member id) -> display name, so we know what to drop on leave/rename
+    self._members = {}
+    self._guild_emojis = {}
+    # bumped on every change so callers can tell when cached formatting is stale
+    self.version = 0
+
+
+  def build(self, guilds):
+    self.users_by_name.clear()
+    self.names_by_id.clear()
+    self.emojis_by_name.clear()
+    self._members.clear()
+    self._guild_emojis.clear()
+    for guild in guilds:
+      for member in guild.members:
+        self.add_member(member)
+      self.set_emojis(guild, guild.emojis)
+
+
+  def add_member(self, member):
+    key = (member.guild.id, member.id)
+    old_name = self._members.get(key)
+    if old_name != member.display_name:
+      self.version += 1
+    if old_name is not None and self.users_by_name.get(old_name) == member.id:
+      del self.users_by_name[old_name]
+    self._members[key] = member.display_name
+    self.users_by_name[member.display_name] = member.id
+    self.names_by_id[str(member.id)] = member.display_name
+
+
+  def remove_member(self, member):
+    self.version += 1
+    name = self._members.pop((member.guild.id, member.id), None)
+    if name is not None and self.users_by_name.get(name) == member.id:
+      del self.users_by_name[name]
+    # still around in another guild?
+    if not any(member_id == member.id for _, member_id in self._members):
+      self.names_by_id.pop(str(member.id), None)
+
+
+  def set_emojis(self, guild, emojis):
+    self.version += 1
+    for emoji in self._guild_emojis.pop(guild.id, []):
+      if self.emojis_by_name.get(emoji.name) == emoji.id:
+        del self.emojis_by_name[emoji.name]
+    self._guild_emojis[guild.id] = list(emojis)
+    for emoji in emojis:
+      self.emojis_by_name[emoji.name] = emoji.id
@@ -0,0 +1,91 @@
+from collections import deque
+
+# recent messages for a channel, fed from gateway events so agents don't each
+# hit channel.history(). falls back to REST on cold start or after a gap.
+
+class ChannelHistory:
+  def __init__(self, limit=20, headroom=20):
+    self.limit = limit
+    # keep a few extra so deletes don't immediately force a refetch
+    self.messages = deque(maxlen=limit + headroom)
+    self.warm = False
+    self.truncated = False
+    # messages that arrive while a refetch is out; merged into its result
+    self.arriving = []
+    self.refetching = 0
+    self.hits = 0
+    self.refetches = 0
+
+
+  def _record(self, message):
+    return {"id": message.id, "author": message.author.display_name, "content": message.content}
+
+
+  def add(self, message):
+    # the snapshot being fetched may or may not have it; hold on to it
+    if self.refetching:
+      self.arriving.append(self._record(message))
+      return
+    # nothing to append to yet, the next read will refetch
+    if not self.warm:
+      return
+    if self.messages and message.id <= self.messages[-1]["id"]:
+      return
+    if len(self.messages) == self.messages.maxlen:
+      self.truncated = True
+    self.messages.append(self._record(message))
+
+
+  def edit(self, message_id, content):
+    for record in self.messages:
+      if record["id"] == message_id:
+        record["content"] = content
+        return
+
+
+  def delete(self, message_ids):
+    self.messages = deque((record for record in self.messages if record["id"] not in message_ids), maxlen=self.messages.maxlen)
+    self.arriving = [record for record in self.arriving if record["id"] not in message_ids]
+
+
+  def invalidate(self):
+    self.warm = False
+
+
+  async def refetch(self, channel):
+    self.refetches += 1
+    self.refetching += 1
+    try:
+      messages = [message async for message in channel.history(limit=self.messages.maxlen)]
+    finally:
+      self.refetching -= 1
+    # gateway messages that came in meanwhile, merged by id
+    records = {message.id: self._record(message) for message in messages}
+    for record in self.arriving:
+      records.setdefault(record["id"], record)
+    if not self.refetching:
+      self.arriving = []
+    self.messages = deque(sorted(records.values(), key=lambda record: record["id"]), maxlen=self.messages.maxlen)
+    self.truncated = len(self.messages) == self.messages.maxlen
+    self.warm = True
+
+
+  async def recent(self, channel, n=None):
+    n = n or self.limit
+    # a short buffer is only trustworthy if the channel really is that short
+    if not self.warm or (len(self.messages) < n and self.truncated):
+      await self.refetch(channel)
+    else:
+      self.hits += 1
+    return list(self.messages)[-n:]
+
+
+  def since(self, message_id):
+    # what's arrived after a message; empty when the buffer can't tell
+    if not self.warm:
+      return []
+    return [record for record in self.messages if record["id"] > message_id]
+
+
+  def stats(self):
+    return {"hits": self.hits, "refetches": self.refetches, "buffered": len(self.messages)}
@@ -0,0 +1,132 @@
+import os
+import pickle
+import numpy as np
+
+# per-agent knowledge base (embeddings.npy + paragraphs.pkl), loaded once and
+# kept resident. reloads when either file changes on disk. for big corpora an
+# IVF index (k-means buckets, pure numpy) can be used instead of a full scan.
+
+SCORE_THRESHOLD = 0.3
+
+
+class KnowledgeIndex:
+  def __init__(self, agent_dir, ann=False, nlist=None, nprobe=8):
+    self.embeddings_file = f'{agent_dir}/embeddings.npy'
+    self.paragraphs_file = f'{agent_dir}/paragraphs.pkl'
+    self.ann = ann
+    self.nlist = nlist
+    self.nprobe = nprobe
+    self._stamp = None
+    self.embeddings = None
+    self.paragraphs = None
+    self.centroids = None
+    self.lists = None
+
+
+  def _file_stamp(self):
+    try:
+      return tuple(os.stat(path).st_mtime_ns for path in (self.embeddings_file, self.paragraphs_file))
+    except FileNotFoundError:
+      return None
+
+
+  def _ensure_loaded(self):
+    stamp = self._file_stamp()
+    if stamp is None:
+      self.embeddings = None
+      self.paragraphs = None
+      self._stamp = None
+      return False
+    if stamp == self._stamp:
+      return True
+
+    try:
+      embeddings = np.load(self.embeddings_file, mmap_mode='r')
+    except ValueError:
+      # object arrays (e.g. a saved list of vectors) can't be mapped
+      embeddings = np.vstack(np.load(self.embeddings_file, allow_pickle=True)).astype(np.float32)
+    if embeddings.ndim == 3:
+      embeddings = embeddings.reshape(len(embeddings), -1)
+    with open(self.paragraphs_file, 'rb') as f:
+      paragraphs = pickle.load(f)
+
+    self.embeddings = embeddings
+    self.paragraphs = paragraphs
+    self.centroids = None
+    self.lists = None
+    self._stamp = stamp
+    if self.ann:
+      self._build_ivf()
+    return True
+
+
+  def _build_ivf(self, iterations=10, chunk_size=65536):
+    n = len(self.embeddings)
+    nlist = min(n, self.nlist or max(1, int(np.sqrt(n))))
+    rng = np.random.default_rng(0)
+    sample = np.asarray(self.embeddings[np.sort(rng.choice(n, min(n, nlist * 40), replace=False))], dtype=np.float32)
+    centroids = sample[rng.choice(len(sample), nlist, replace=False)].copy()
+
+    def assign(vectors):
+      # nearest centroid by L2: argmax(x.c - |c|^2 / 2)
+      return np.argmax(vectors @ centroids.T - 0.5 * np.sum(centroids ** 2, axis=1), axis=1)
+
+    for _ in range(iterations):
+      labels = assign(sample)
+      for j in range(nlist):
+        members = sample[labels == j]
+        if len(members):
+          centroids[j] = members.mean(axis=0)
+
+    labels = np.concatenate([
+      assign(np.asarray(self.embeddings[start:start + chunk_size], dtype=np.float32))
+      for start in range(0, n, chunk_size)
+    ])
+    order = np.argsort(labels, kind='stable')
+    bounds = np.searchsorted(labels[order], np.arange(nlist + 1))
+    self.centroids = centroids
+    self.lists = [order[bounds[j]:bounds[j + 1]] for j in range(nlist)]
+
+
+  def _top_k(self, similarities, candidates, top_k):
+    top_k = min(top_k, len(similarities))
+    if top_k == 0:
+      return []
+    top_k_indices = np.argpartition(similarities, -top_k)[-top_k:]
+    top_k_indices = top_k_indices[np.argsort(similarities[top_k_indices])][::-1]
+    return [(int(candidates[i]) if candidates is not None else int(i), float(similarities[i])) for i in top_k_indices]
+
+
+  def search(self, query_embeddings, top_k=2):
+    query_embeddings = np.atleast_2d(np.asarray(query_embeddings, dtype=np.float32))
+    if not self._ensure_loaded() or len(self.embeddings) == 0:
+      return [[] for _ in query_embeddings]
+
+    if self.centroids is None:
+      # exact: every query against the whole matrix in one product
+      similarities = np.asarray(self.embeddings @ query_embeddings.T)
+      return [self._top_k(similarities[:, q], None, top_k) for q in range(len(query_embeddings))]
+
+    results = []
+    probes = np.argsort(query_embeddings @ self.centroids.T, axis=1)[:, ::-1][:, :self.nprobe]
+    for query, probe in zip(query_embeddings, probes):
+      candidates = np.sort(np.concatenate([self.lists[j] for j in probe]))
+      similarities = np.asarray(self.embeddings[candidates] @ query)
+      results.append(self._top_k(similarities, candidates, top_k))
+    return results
+
+
+  def retrieve(self, query_embeddings, top_k=2, threshold=SCORE_THRESHOLD):
+    return [
+      '\n'.join(self.paragraphs[i][1] for i, score in hits if score > threshold)
+      for hits in self.search(query_embeddings, top_k)
+    ]
+
+
+_indexes = {}
+
+def get_knowledge_index(agent_dir):
+  # shared per directory so re-adding an agent doesn't reload its corpus
+  if agent_dir not in _indexes:
+    _indexes[agent_dir] = KnowledgeIndex(agent_dir, ann=os.getenv('KNOWLEDGE_ANN') == '1')
+  return _indexes[agent_dir]
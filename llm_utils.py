@@ -1,22 +1,81 @@
-from openai import OpenAI
-from anthropic import Anthropic
 import os
+from functools import cache
 from dotenv import load_dotenv
 import numpy as np
 import pickle
-from sentence_transformers import SentenceTransformer
+from embedding_utils import embedding_service
+from startup_utils import timed
+from retry_utils import with_retries, anthropic_limiter, openai_limiter
+from cache_utils import completion_key, make_completion_cache
+from metrics_utils import metrics, current_agent, usage_sink
 
 load_dotenv()
 
-client = OpenAI(api_key = os.getenv('OPENAI_API_KEY'))
+# SDK clients are built on first use; importing openai/anthropic alone costs
+# over a second, and the bot shouldn't wait on that to reach the gateway
+@cache
+def openai_client():
+  with timed('openai client'):
+    from openai import OpenAI
+    return OpenAI(api_key = os.getenv('OPENAI_API_KEY'))
 
-anthropic = Anthropic()
-anthropic.api_key = os.getenv('ANTHROPIC_API_KEY')
+@cache
+def anthropic_client():
+  with timed('anthropic client'):
+    from anthropic import Anthropic
+    return Anthropic(api_key = os.getenv('ANTHROPIC_API_KEY'))
+
+# async clients so completions don't block the discord event loop. retries
+# and timeouts are handled by with_retries, so the SDK's own are turned off
+@cache
+def async_openai_client():
+  with timed('async openai client'):
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key = os.getenv('OPENAI_API_KEY'), max_retries=0)
+
+@cache
+def async_anthropic_client():
+  with timed('async anthropic client'):
+    from anthropic import AsyncAnthropic
+    return AsyncAnthropic(api_key = os.getenv('ANTHROPIC_API_KEY'), max_retries=0)
+
+REQUEST_TIMEOUT = float(os.getenv('LLM_REQUEST_TIMEOUT', 60))
+# fall back to openai when claude keeps failing, if there's a key for it
+FAILOVER_ENABLED = bool(os.getenv('OPENAI_API_KEY')) and os.getenv('LLM_FAILOVER', '1') == '1'
+
+# None unless COMPLETION_CACHE=memory|sqlite
+completion_cache = make_completion_cache()
+
+OPENAI_MODEL = 'gpt-4o'
+CLAUDE_MODEL = "claude-3-5-sonnet-20240620"
+CLAUDE_SMALL_MODEL = "claude-3-haiku-20240307"
+
+USAGE_FIELDS = (
+  ('input', 'input_tokens'), ('output', 'output_tokens'),
+  ('cache_read', 'cache_read_input_tokens'), ('cache_write', 'cache_creation_input_tokens'),
+  # openai's names
+  ('input', 'prompt_tokens'), ('output', 'completion_tokens'),
+)
+
+def record_usage(usage, agent=None):
+  if usage is None:
+    return
+  agent = agent or current_agent.get()
+  # a round completion speaks for several agents; they split the bill
+  agents = agent if isinstance(agent, (list, tuple)) else [agent]
+  sink = usage_sink.get()
+  for kind, field in USAGE_FIELDS:
+    tokens = getattr(usage, field, None)
+    if tokens:
+      for name in agents:
+        metrics.incr('tokens', tokens / len(agents), agent=name, kind=kind)
+      if sink is not None:
+        sink[kind] = sink.get(kind, 0) + tokens
 
 def generate_completion(messages):
   try:
-    response = client.chat.completions.create(
-      model='gpt-4o',
+    response = openai_client().chat.completions.create(
+      model=OPENAI_MODEL,
       messages=messages,
       temperature=1)
     content = response.choices[0].message.content
@@ -25,14 +84,43 @@ def generate_completion(messages):
     print(f"Error generating completion: {e}")
     raise e
 
+async def generate_completion_async(messages, temperature=1, max_tokens=None):
+  try:
+    response = await with_retries(
+      lambda: async_openai_client().chat.completions.with_raw_response.create(
+        model=OPENAI_MODEL,
+        messages=messages,
+        temperature=temperature,
+        max_tokens=max_tokens),
+      openai_limiter,
+      tokens=estimate_request_tokens(messages, None, max_tokens or 0),
+      timeout=REQUEST_TIMEOUT)
+    record_usage(response.usage)
+    content = response.choices[0].message.content
+    return content
+  except Exception as e:
+    print(f"Error generating completion: {e}")
+    raise e
+
 def simple_completion(prompt):
   messages = [{"role": "user", "content": prompt}]
   return generate_completion(messages)
 
-def generate_completion_claude(messages, system, temperature=1, max_tokens=250):
+async def simple_completion_async(prompt):
+  messages = [{"role": "user", "content": prompt}]
+  return await generate_completion_async(messages)
+
+def _is_cached(system):
+  return isinstance(system, list) and any('cache_control' in block for block in system)
+
+def _claude_messages(client, system):
+  # prompt caching (cache_control blocks) is still behind the beta endpoint
+  return client.beta.prompt_caching.messages if _is_cached(system) else client.messages
+
+def generate_completion_claude(messages, system, temperature=1, max_tokens=250, model=CLAUDE_MODEL):
   try:
-      response = anthropic.messages.create(
-          model="claude-3-5-sonnet-20240620",
+      response = _claude_messages(anthropic_client(), system).create(
+          model=model,
           max_tokens=max_tokens,
           temperature=temperature,
           messages=messages,
@@ -44,10 +132,117 @@ def generate_completion_claude(messages, system, temperature=1, max_tokens=250):
       print(f"Error generating completion: {e}")
       raise e
 
+def _block_text(content):
+  if isinstance(content, str):
+    return content
+  return "\n\n".join(block['text'] for block in content if block.get('type') == 'text')
+
+def to_openai_messages(messages, system):
+  openai_messages = [{"role": "system", "content": _block_text(system)}] if system else []
+  for message in messages:
+    openai_messages.append({"role": message['role'], "content": _block_text(message['content'])})
+  return openai_messages
+
+def estimate_request_tokens(messages, system, max_tokens):
+  # rough, only used to pace against the provider's token budget
+  text = _block_text(system or "") + "".join(_block_text(message['content']) for message in messages)
+  return len(text) // 4 + max_tokens
+
+async def _create_claude_async(messages, system, temperature, max_tokens, model, stream=False):
+  return await with_retries(
+    lambda: _claude_messages(async_anthropic_client(), system).with_raw_response.create(
+      model=model,
+      max_tokens=max_tokens,
+      temperature=temperature,
+      messages=messages,
+      system=system,
+      stream=stream),
+    anthropic_limiter,
+    tokens=estimate_request_tokens(messages, system, max_tokens),
+    timeout=REQUEST_TIMEOUT)
+
+async def _cache_lookup(messages, system, temperature, max_tokens, model):
+  if completion_cache is None:
+    return None, None
+  key = completion_key(model, system, messages, temperature=temperature, max_tokens=max_tokens)
+  return key, await completion_cache.get(key)
+
+async def generate_completion_claude_async(messages, system, temperature=1, max_tokens=250, model=CLAUDE_MODEL):
+  key, cached = await _cache_lookup(messages, system, temperature, max_tokens, model)
+  if cached is not None:
+    return cached
+  try:
+    response = await _create_claude_async(messages, system, temperature, max_tokens, model)
+    record_usage(response.usage)
+    content = response.content[0].text
+    # failover answers aren't cached, only real claude ones
+    if key:
+      await completion_cache.set(key, content)
+    return content
+  except Exception as e:
+    print(f"Error generating completion: {e}")
+    if not FAILOVER_ENABLED:
+      raise e
+  print("Failing over to openai")
+  metrics.incr('failovers')
+  return await generate_completion_async(to_openai_messages(messages, system), temperature, max_tokens)
+
+async def stream_completion_claude_async(messages, system, temperature=1, max_tokens=250, model=CLAUDE_MODEL):
+  # yields text deltas; closing the generator early aborts the request.
+  # retries only cover opening the stream, never a half-read one
+  key, cached = await _cache_lookup(messages, system, temperature, max_tokens, model)
+  if cached is not None:
+    yield cached
+    return
+  # the tail of the stream is read from the delivery task, so remember the agent now
+  agent = current_agent.get()
+  try:
+    stream = await _create_claude_async(messages, system, temperature, max_tokens, model, stream=True)
+  except Exception as e:
+    print(f"Error generating completion: {e}")
+    if not FAILOVER_ENABLED:
+      raise e
+    print("Failing over to openai")
+    metrics.incr('failovers')
+    yield await generate_completion_async(to_openai_messages(messages, system), temperature, max_tokens)
+    return
+  parts = []
+  try:
+    async for event in stream:
+      if event.type == 'content_block_delta' and event.delta.type == 'text_delta':
+        parts.append(event.delta.text)
+        yield event.delta.text
+      elif event.type == 'message_start':
+        record_usage(event.message.usage, agent)
+      elif event.type == 'message_delta':
+        record_usage(event.usage, agent)
+  finally:
+    await stream.close()
+  # only reached when the stream ran to the end, aborted ones aren't cached
+  if key:
+    await completion_cache.set(key, "".join(parts))
+
 def simple_completion_claude(message, system=None, max_tokens=5):
   messages = [{"role": "user", "content": message}]
   return generate_completion_claude(messages, system, max_tokens=max_tokens)
 
+async def simple_completion_claude_async(message, system=None, max_tokens=5):
+  messages = [{"role": "user", "content": message}]
+  return await generate_completion_claude_async(messages, system, max_tokens=max_tokens)
+
+_tokenizer_failed = False
+
+def count_tokens(text):
+  # local claude tokenizer; falls back to a rough chars/4 estimate
+  global _tokenizer_failed
+  if not _tokenizer_failed:
+    try:
+      return anthropic_client().count_tokens(text)
+    except Exception as e:
+      print(f"Warning: tokenizer unavailable, estimating token counts: {e}")
+      _tokenizer_failed = True
+  return len(text) // 4 + 1
+
 def fill_prompt(prompt, placeholders, game):
   for placeholder, value in placeholders.items():
     if placeholder in prompt:
@@ -83,9 +278,8 @@ def clean_response(response, bot):
 def format_response(response, bot):
   words = response.split()
 
-  # Cache emojis and users
-  emojis = {emoji.name: emoji.id for guild in bot.guilds for emoji in guild.emojis}
-  users = {member.display_name: member.id for guild in bot.guilds for member in guild.members}
+  emojis = bot.guild_index.emojis_by_name
+  users = bot.guild_index.users_by_name
     
   # MENTIONS
   for i, word in enumerate(words):
@@ -104,9 +298,19 @@ def format_response(response, bot):
   
   return ' '.join(words)
 
-sentence_transformer = SentenceTransformer('all-MiniLM-L6-v2')
+# blocking: runs the model on the calling thread. for scripts and threads
+# only; anything on the event loop uses the async versions below
 def get_embedding(text):
-  return sentence_transformer.encode([text], show_progress_bar=False)
+  return embedding_service.encode([text])
+
+def get_embeddings(texts):
+  return embedding_service.encode(texts)
+
+async def get_embedding_async(text):
+  return (await embedding_service.embed(text))[None, :]
+
+async def get_embeddings_async(texts):
+  return await embedding_service.embed_many(texts)
 
 def cosine_similarity(embedding1, embedding2):
   return np.dot(embedding1, embedding2) / (np.linalg.norm(embedding1) * np.linalg.norm(embedding2))
@@ -1,141 +1,202 @@
+from startup_utils import timed, mark, startup_report
 import random
-import discord
-from discord.ext import tasks, commands
+with timed('import discord'):
+  import discord
+  from discord.ext import tasks, commands
 import os
 from dotenv import load_dotenv
 import time
 import asyncio
 import json
 
-from agent_utils import *
-from llm_utils import *
+with timed('import agent modules'):
+  from agent_utils import *
+  from llm_utils import *
+  from history_utils import ChannelHistory
+  from guild_utils import GuildIndex
+  from config_utils import config
+  from conversation_utils import Conversation
+  from gating_utils import make_gate
+  from metrics_utils import metrics
+  from state_utils import make_state
+  from consolidation_utils import ConsolidationWorker
+  from shard_utils import make_router
 load_dotenv()
 
 BOT_TOKEN = os.getenv('BOT_TOKEN')
-GENERAL_CHANNEL_ID = int(os.getenv('GENERAL_CHANNEL_ID'))
+GENERAL_CHANNEL_ID = int(os.getenv('GENERAL_CHANNEL_ID', 0))
+# extra channels to serve, comma separated; the general channel is always on
+CHANNEL_IDS = {GENERAL_CHANNEL_ID} | {int(id) for id in os.getenv('CHANNEL_IDS', '').split(',') if id.strip()}
 
-AGENTS_DIR = 'agents'
-AGENTS_FILE = 'configs/online_agents.txt'
+# text files under configs/ and agents/, or one sqlite db if STATE_DB is set
+state = make_state(GENERAL_CHANNEL_ID)
 
 def get_all_agent_names():
-  return [f for f in os.listdir(AGENTS_DIR) if os.path.isdir(os.path.join(AGENTS_DIR, f))]
-
-def save_active_agents(agents):
-  with open(AGENTS_FILE, 'w') as f:
-    for agent in agents:
-      f.write(f"{agent.name}\n")
-
-def load_active_agents():
-  try:
-    with open(AGENTS_FILE, 'r') as f:
-      return [line.strip() for line in f if line.strip()]
-  except FileNotFoundError:
+  return state.agent_names()
+
+def load_active_agents(channel_id=GENERAL_CHANNEL_ID):
+  roster = state.roster(channel_id)
+  if roster is None:
+    if channel_id != GENERAL_CHANNEL_ID:
+      return load_active_agents()  # new channels start with the general roster
     return ["adobo", "bingus"]  # Default agents if file doesn't exist
+  return roster
 
 all_agent_names = get_all_agent_names()
-active_agent_names = load_active_agents()
 
 class DiscordBot(commands.Bot):
   def __init__(self, *args, **kwargs):
     super().__init__(*args, **kwargs)
-    self.channel = None
-    self.last_processed_time = 0
-    self.processing_interval = 10
-    self.agent_last_response = {}
-    self.processing_task = None
-    self.agents = [Agent(name, self) for name in active_agent_names if name in all_agent_names]
-    self.message_cooldown = 4 
+    self.conversations = {}
+    self.state = state
+    # memory upkeep waits until no channel is mid-turn
+    self.consolidator = ConsolidationWorker(state, is_busy=lambda: any(c.turn_active for c in self.conversations.values()))
+    self.consolidation_task = None
+    self.max_concurrent_responses = int(os.getenv('MAX_CONCURRENT_RESPONSES', 4))
+    self.completion_semaphore = asyncio.Semaphore(int(os.getenv('MAX_CONCURRENT_COMPLETIONS', 32)))
+    self.guild_index = GuildIndex()
+    # agent workers, if configured; None runs agents in this process
+    self.router = make_router(state)
+    self.speak_gate = make_gate()
+    self.config_watcher = None
+    self.warm_up_task = None
+    self.metrics_tasks = []
+    self.register_metrics()
+
+  def register_metrics(self):
+    # other components keep their own counters; !stats and the exporters read them from here
+    metrics.register('speak_gate', self.speak_gate.summary)
+    metrics.register('embeddings', embedding_service.stats)
+    metrics.register('history', lambda: {
+      key: sum(conversation.history.stats()[key] for conversation in self.conversations.values())
+      for key in ('hits', 'refetches')
+    })
+    metrics.register('rate_limits', lambda: {"anthropic_waits": anthropic_limiter.waits, "openai_waits": openai_limiter.waits})
+    if completion_cache is not None:
+      metrics.register('completion_cache', completion_cache.stats)
+    metrics.register('consolidation', lambda: {"pending": len(self.consolidator.pending), "running": len(self.consolidator.running)})
+    if hasattr(self.state, 'stats'):
+      metrics.register('state', self.state.stats)
+    if self.router:
+      metrics.register('workers', self.router.stats)
 
   async def on_ready(self):
     print(f'Logged on as {self.user}!')
-    self.channel = self.get_channel(GENERAL_CHANNEL_ID)
-    print(f"Initialized agents: {[agent.name for agent in self.agents]}")
+    self.guild_index.build(self.guilds)
+    if self.config_watcher is None:
+      mark('gateway ready')
+      self.config_watcher = asyncio.create_task(config.watch())
+      self.warm_up_task = asyncio.create_task(self.warm_up())
+      self.metrics_tasks = metrics.start()
+      self.consolidation_task = asyncio.create_task(self.consolidator.run())
+    for channel_id in CHANNEL_IDS:
+      channel = self.get_channel(channel_id)
+      if channel:
+        conversation = self.get_conversation(channel)
+        print(f"Initialized agents in #{channel.name}: {[agent.name for agent in conversation.agents]}")
     print(f"All available agent names: {all_agent_names}")
+    await self.place_agents()
+
+  async def place_agents(self):
+    # every rostered agent on its worker; agents nobody rosters any more are dropped
+    if self.router:
+      try:
+        await self.router.rebalance({agent.name for conversation in self.conversations.values() for agent in conversation.agents})
+      except ConnectionError as e:
+        # workers that aren't up yet get pinged again; agents are placed once one answers
+        print(f"placing agents: {e}")
 
-  async def read_channel(self):
-    messages = [message async for message in self.channel.history(limit=20)]
-    messages.reverse()
-    return [
-      add_message(message.author.display_name, message.content)
-      for message in messages
-      if not message.content.startswith('!')
-    ]
+  async def warm_up(self):
+    # heavy clients/models load in the background once we're already connected
+    await asyncio.to_thread(async_anthropic_client)
+    await asyncio.to_thread(count_tokens, '')  # loads the sync client + tokenizer
+    if os.getenv('WARM_EMBEDDINGS') == '1':
+      await embedding_service.warm_up()
+    print(startup_report())
+
+  def get_conversation(self, channel):
+    if channel.id not in CHANNEL_IDS:
+      return None
+    conversation = self.conversations.get(channel.id)
+    if conversation is None:
+      agent_names = [name for name in load_active_agents(channel.id) if name in all_agent_names]
+      conversation = Conversation(self, channel, agent_names, self.completion_semaphore, self.max_concurrent_responses)
+      self.conversations[channel.id] = conversation
+    return conversation
 
   async def on_message(self, message):
-    if message.channel.id != GENERAL_CHANNEL_ID:
+    conversation = self.get_conversation(message.channel)
+    if conversation is None:
       return
     
+    conversation.history.add(message)
     await super().on_message(message)
     
     # Skip processing for command messages
     if message.content.startswith('!'):
       return
     
-    if self.processing_task and not self.processing_task.done():
-      self.processing_task.cancel()
-    
-    self.processing_task = asyncio.create_task(self.delayed_process_message(message))
-
-  async def delayed_process_message(self, message):
-    await asyncio.sleep(self.message_cooldown)
-    await self.process_message(message)
-
-  async def process_message(self, message):
-    try:
-      current_time = time.time()
-      if current_time - self.last_processed_time < self.processing_interval:
-        await asyncio.sleep(self.processing_interval - (current_time - self.last_processed_time))
-
-      self.last_processed_time = time.time()
-
-      last_two_messages = [message async for message in self.channel.history(limit=2)]
-      message_author = message.author.display_name
-      shuffled_agents = self.agents.copy()
-      shuffled_agents = [agent for agent in shuffled_agents if agent.name != message_author]
-      random.shuffle(shuffled_agents)
-      
-      # Check for mentions in the last two messages
-      mentioned_agents = [
-        agent for agent in shuffled_agents 
-        if any(f"@{agent.name}" in msg.content for msg in last_two_messages)
-      ]
-      if len(mentioned_agents) > 0:
-        names = [agent.name for agent in mentioned_agents]
-        print(f"MENTIONED: {names}")
-      
-      # pop them out
-      shuffled_agents = [agent for agent in shuffled_agents if agent not in mentioned_agents]
-      
-      # put mentioned agents at the front
-      shuffled_agents = mentioned_agents + shuffled_agents
-      
-      for agent in shuffled_agents:
-        if time.time() - self.agent_last_response.get(agent.name, 0) >= self.processing_interval:
-          # Read the channel before responding
-          channel_messages = await self.read_channel()
-          agent.messages = channel_messages
-          
-          response = agent.respond()
-          if "[null]" not in response:
-            print(f"{agent.name}: responding")
-            response = clean_response(response, self)
-            # print(f"{agent.name}: {response}")
-            formatted_response = format_response(response, self)
-            formatted_response = format_agent_message(agent.name, formatted_response)
-            await self.channel.send(formatted_response)
-            self.agent_last_response[agent.name] = time.time()
-          else:
-            print(f"{agent.name}: intent no")
-    except asyncio.CancelledError:
-      # print("new message, new process")
-      pass
+    conversation.on_message(message)
+
+  async def on_raw_message_edit(self, payload):
+    conversation = self.conversations.get(payload.channel_id)
+    if conversation and 'content' in payload.data:
+      conversation.history.edit(payload.message_id, payload.data['content'])
+
+  async def on_raw_message_delete(self, payload):
+    conversation = self.conversations.get(payload.channel_id)
+    if conversation:
+      conversation.history.delete({payload.message_id})
+
+  async def on_raw_bulk_message_delete(self, payload):
+    conversation = self.conversations.get(payload.channel_id)
+    if conversation:
+      conversation.history.delete(payload.message_ids)
+
+  async def on_guild_join(self, guild):
+    for member in guild.members:
+      self.guild_index.add_member(member)
+    self.guild_index.set_emojis(guild, guild.emojis)
+
+  async def on_guild_remove(self, guild):
+    self.guild_index.build(self.guilds)
+
+  async def on_member_join(self, member):
+    self.guild_index.add_member(member)
+
+  async def on_member_update(self, before, after):
+    self.guild_index.add_member(after)
+
+  async def on_user_update(self, before, after):
+    # username changes show up as display name changes in every guild
+    for guild in self.guilds:
+      member = guild.get_member(after.id)
+      if member:
+        self.guild_index.add_member(member)
+
+  async def on_member_remove(self, member):
+    self.guild_index.remove_member(member)
+
+  async def on_guild_emojis_update(self, guild, before, after):
+    self.guild_index.set_emojis(guild, after)
+
+  async def on_disconnect(self):
+    # events may be missed while we're gone
+    for conversation in self.conversations.values():
+      conversation.history.invalidate()
+
+  async def close(self):
+    # queued state writes land before we exit
+    await self.state.flush()
+    await super().close()
 
 intents = discord.Intents.default()
 intents.message_content = True
 intents.members = True
 intents.guilds = True
 
-client = DiscordBot(command_prefix='!', intents=intents)
+with timed('bot + agents init'):
+  client = DiscordBot(command_prefix='!', intents=intents)
 
 @client.command()
 @commands.has_permissions(administrator=True)
@@ -150,18 +211,16 @@ async def prune(ctx, n: int):
 @client.command()
 async def vip(ctx, name: str = None):
   target = name if name else ctx.author.name
-  with open('configs/vips.txt', 'r') as file:
-    vips = set(file.read().splitlines())
+  vips = client.state.vips()
   
   if target in vips:
     vips.remove(target)
     action = "removed from"
   else:
-    vips.add(target)
+    vips.append(target)
     action = "added to"
   
-  with open('configs/vips.txt', 'w') as file:
-    file.write('\n'.join(vips))
+  await client.state.set_vips(vips)
   
   await ctx.send(f"**World**: {target} has been {action} the VIP list.")
 
@@ -169,9 +228,11 @@ async def vip(ctx, name: str = None):
 @client.command()
 async def kill(ctx, arg: str, verbose: bool = False):
   print("KILLING AGENT")
-  if arg in [agent.name for agent in client.agents]:
-    client.agents = [agent for agent in client.agents if agent.name != arg]
-    save_active_agents(client.agents)
+  conversation = client.get_conversation(ctx.channel)
+  if arg in [agent.name for agent in conversation.agents]:
+    conversation.agents = [agent for agent in conversation.agents if agent.name != arg]
+    await conversation.save_roster()
+    await client.place_agents()
     if verbose:
       await ctx.send(f"**World**: {ctx.author.name} killed {arg}. {arg} has left the chat")
     else:
@@ -182,40 +243,43 @@ async def kill(ctx, arg: str, verbose: bool = False):
 @client.command()
 async def add(ctx, name: str, *, description: str = None):
   print(f"ADDING AGENT: {name}")
-  if name not in [agent.name for agent in client.agents]:
-    agent_dir = f'{AGENTS_DIR}/{name}'
-    prompt_file = f'{agent_dir}/prompt.txt'
-    scratch_memory_file = f'{agent_dir}/scratch_memory.txt'
-    long_term_memory_file = f'{agent_dir}/long_term_memory.txt'
-    
+  conversation = client.get_conversation(ctx.channel)
+  if name not in [agent.name for agent in conversation.agents]:
     # if new agent
-    if not os.path.exists(agent_dir):
-      os.makedirs(agent_dir)
+    if name not in client.state.agent_names():
+      if not valid_agent_name(name):
+        await ctx.send(f"**World**: {name} can't be a name, stick to letters, numbers, dots, dashes and underscores.")
+        return
       if description is not None:
-        with open(prompt_file, 'w') as file:
-          file.write(description)
-        # make memory
-        open(scratch_memory_file, 'w').close()
-        open(long_term_memory_file, 'w').close()
+        await client.state.set_prompt(name, description)
       else:
         await ctx.send(f"**World**: {name} needs a description to be added.")
         return
     
 
-    client.agents.append(Agent(name, client))
+    conversation.agents.append(Agent(name, client))
     if name not in all_agent_names:
       all_agent_names.append(name)
     
-    save_active_agents(client.agents)
+    await conversation.save_roster()
+    await client.place_agents()
     await ctx.send(f"**World**: {name} has joined the chat")
   else:
     await ctx.send(f"**World**: {name} is already in the chat")
 
+@client.command()
+async def stats(ctx, agent: str = None):
+  report = metrics.report(agent)
+  # discord caps messages at 2000 characters
+  if len(report) > 1900:
+    report = report[:1900] + "\n..."
+  await ctx.send(f"**World**: ```\n{report}\n```")
+
 @client.command()
 async def list(ctx):
   global all_agent_names
   all_agent_names = get_all_agent_names()  # Refresh the list
-  online_agent_names = [agent.name for agent in client.agents]
+  online_agent_names = [agent.name for agent in client.get_conversation(ctx.channel).agents]
   offline_agent_names = [name for name in all_agent_names if name not in online_agent_names]
   
   online_list = ", ".join(online_agent_names) if online_agent_names else "None"
@@ -223,4 +287,5 @@ async def list(ctx):
   
   await ctx.send(f"**World**: \nOnline: {online_list}\n\nOffline: {offline_list}")
 
-client.run(BOT_TOKEN)
\ No newline at end of file
+if __name__ == '__main__':
+  client.run(BOT_TOKEN)
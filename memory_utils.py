@@ -0,0 +1,145 @@
+import os
+import json
+import pickle
+from datetime import datetime
+import numpy as np
+
+# long-term memory store. embeddings are normalized on the way in and appended
+# as raw float32 rows to embeddings.f32, which is memory-mapped for search;
+# memory text goes line-by-line into memories.jsonl. retrieval is one
+# matrix-vector product plus argpartition, nothing gets re-embedded.
+
+EMBEDDING_DIM = 384  # all-MiniLM-L6-v2
+
+
+def normalize(embeddings):
+  embeddings = np.asarray(embeddings, dtype=np.float32)
+  if embeddings.ndim == 1:
+    embeddings = embeddings[None, :]
+  norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+  norms[norms == 0] = 1
+  return embeddings / norms
+
+
+class MemoryStore:
+  def __init__(self, memory_dir, dim=EMBEDDING_DIM):
+    self.memory_dir = memory_dir
+    self.dim = dim
+    self.embeddings_file = f'{memory_dir}/embeddings.f32'
+    self.memories_file = f'{memory_dir}/memories.jsonl'
+    self._memories = None
+    self._matrix = None
+    self._rows = 0
+
+
+  def _load(self):
+    if self._memories is not None:
+      return
+    if not os.path.exists(self.memories_file):
+      self._import_legacy()
+    self._memories = []
+    torn = False
+    if os.path.exists(self.memories_file):
+      with open(self.memories_file, 'r') as file:
+        for line in file:
+          try:
+            self._memories.append(json.loads(line))
+          except json.JSONDecodeError:
+            torn = True
+            break
+    self._repair(torn)
+
+
+  def _repair(self, torn):
+    # a crash mid-append can leave an extra row or a torn line; trim both
+    # files back to the last complete memory so later appends stay aligned
+    size = os.path.getsize(self.embeddings_file) if os.path.exists(self.embeddings_file) else 0
+    count = min(len(self._memories), size // (4 * self.dim))
+    if size != count * 4 * self.dim:
+      os.truncate(self.embeddings_file, count * 4 * self.dim)
+    if torn or len(self._memories) > count:
+      self._memories = self._memories[:count]
+      with open(self.memories_file, 'w') as file:
+        for record in self._memories:
+          file.write(json.dumps(record) + "\n")
+
+
+  def _import_legacy(self):
+    # old layout: memory.pkl (list of (timestamp, text) or text) + embeddings.npy
+    legacy_memories = f'{self.memory_dir}/memory.pkl'
+    legacy_embeddings = f'{self.memory_dir}/embeddings.npy'
+    if not os.path.exists(legacy_memories) or os.path.getsize(legacy_memories) == 0:
+      return
+    with open(legacy_memories, 'rb') as file:
+      memories = pickle.load(file)
+    embeddings = np.load(legacy_embeddings) if os.path.exists(legacy_embeddings) else np.empty((0, self.dim))
+    if len(memories) != len(embeddings):
+      print(f"Warning: {legacy_memories} has {len(memories)} memories but {len(embeddings)} embeddings, skipping import")
+      return
+    records = []
+    for memory in memories:
+      if isinstance(memory, tuple):
+        records.append({"time": memory[0], "text": memory[1]})
+      else:
+        records.append({"time": None, "text": memory})
+    self._append(records, normalize(embeddings) if len(embeddings) else np.empty((0, self.dim), dtype=np.float32))
+
+
+  def _append(self, records, embeddings):
+    os.makedirs(self.memory_dir, exist_ok=True)
+    # embeddings first: a row without text is ignored, text without a row never happens
+    with open(self.embeddings_file, 'ab') as file:
+      file.write(np.ascontiguousarray(embeddings, dtype=np.float32).tobytes())
+    with open(self.memories_file, 'a') as file:
+      for record in records:
+        file.write(json.dumps(record) + "\n")
+
+
+  def _get_matrix(self):
+    if not os.path.exists(self.embeddings_file):
+      return np.empty((0, self.dim), dtype=np.float32)
+    rows = os.path.getsize(self.embeddings_file) // (4 * self.dim)
+    if self._matrix is None or rows != self._rows:
+      self._rows = rows
+      self._matrix = np.memmap(self.embeddings_file, dtype=np.float32, mode='r', shape=(rows, self.dim)) if rows else np.empty((0, self.dim), dtype=np.float32)
+    return self._matrix
+
+
+  def __len__(self):
+    self._load()
+    return min(len(self._memories), len(self._get_matrix()))
+
+
+  def records(self):
+    # (memories, embeddings) for copying the store somewhere else
+    count = len(self)
+    return self._memories[:count], np.asarray(self._get_matrix()[:count])
+
+
+  def add(self, text, embedding, timestamp=None):
+    self.add_many([text], embedding, [timestamp])
+
+
+  def add_many(self, texts, embeddings, timestamps=None):
+    self._load()
+    embeddings = normalize(embeddings)
+    timestamps = timestamps or [None] * len(texts)
+    records = [
+      {"time": timestamp or datetime.now().isoformat(), "text": text}
+      for text, timestamp in zip(texts, timestamps)
+    ]
+    self._append(records, embeddings)
+    self._memories.extend(records)
+
+
+  def search(self, query_embedding, top_k=3):
+    count = len(self)
+    if count == 0:
+      return []
+    matrix = self._get_matrix()[:count]
+    query = normalize(query_embedding)[0]
+    similarities = matrix @ query
+    top_k = min(top_k, count)
+    top_k_indices = np.argpartition(similarities, -top_k)[-top_k:]
+    top_k_indices = top_k_indices[np.argsort(similarities[top_k_indices])][::-1]
+    return [(self._memories[i]["text"], float(similarities[i])) for i in top_k_indices]
@@ -0,0 +1,210 @@
+import os
+import json
+import time
+import asyncio
+import tempfile
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+# counters and timing spans for the hot path. everything lives in memory and
+# is read through !stats, an optional prometheus text endpoint
+# (METRICS_PORT) or a periodic json dump (METRICS_DUMP_PATH).
+
+# which agent (or list of agents, for a round) the current task is working
+# for, so the llm layer can attribute token usage without threading the agent
+# through every call
+current_agent = contextvars.ContextVar('current_agent', default=None)
+# optional dict the llm layer also adds token usage to, for work done on
+# behalf of another process (an agent worker reports it back to the gateway)
+usage_sink = contextvars.ContextVar('usage_sink', default=None)
+
+SAMPLES_PER_SPAN = 512
+
+
+def _key(name, labels):
+  return (name, tuple(sorted((k, str(v)) for k, v in labels.items() if v is not None)))
+
+
+def _percentile(values, p):
+  values = sorted(values)
+  return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class Metrics:
+  def __init__(self):
+    self.counters = {}
+    # (name, labels) -> {"count", "total", "max", "samples"}; samples are the
+    # most recent durations, enough for p50/p95 without unbounded growth
+    self.spans = {}
+    self.collectors = {}
+    self.started_at = time.time()
+
+
+  def incr(self, name, value=1, **labels):
+    key = _key(name, labels)
+    self.counters[key] = self.counters.get(key, 0) + value
+
+
+  def get(self, name, **labels):
+    return self.counters.get(_key(name, labels), 0)
+
+
+  def observe(self, name, seconds, **labels):
+    key = _key(name, labels)
+    span = self.spans.get(key)
+    if span is None:
+      span = self.spans[key] = {"count": 0, "total": 0.0, "max": 0.0, "samples": deque(maxlen=SAMPLES_PER_SPAN)}
+    span["count"] += 1
+    span["total"] += seconds
+    span["max"] = max(span["max"], seconds)
+    span["samples"].append(seconds)
+
+
+  @contextmanager
+  def span(self, name, **labels):
+    start = time.perf_counter()
+    try:
+      yield
+    finally:
+      self.observe(name, time.perf_counter() - start, **labels)
+
+
+  def register(self, name, collect):
+    # collect() returns a flat dict of numbers, read whenever stats are asked for
+    self.collectors[name] = collect
+
+
+  def _collected(self):
+    collected = {}
+    for name, collect in self.collectors.items():
+      try:
+        collected[name] = {k: v for k, v in (collect() or {}).items() if isinstance(v, (int, float))}
+      except Exception as e:
+        print(f"metrics: {name} collector failed: {e}")
+    return collected
+
+
+  def summary(self):
+    spans = {}
+    for (name, labels), span in self.spans.items():
+      spans.setdefault(name, []).append({
+        "labels": dict(labels),
+        "count": span["count"],
+        "mean": span["total"] / span["count"],
+        "p50": _percentile(span["samples"], 50),
+        "p95": _percentile(span["samples"], 95),
+        "max": span["max"],
+      })
+    counters = {}
+    for (name, labels), value in self.counters.items():
+      counters.setdefault(name, []).append({"labels": dict(labels), "value": value})
+    return {
+      "uptime": time.time() - self.started_at,
+      "spans": spans,
+      "counters": counters,
+      "collected": self._collected(),
+    }
+
+
+  def report(self, agent=None):
+    # short enough for one discord message
+    lines = [f"uptime {(time.time() - self.started_at) / 3600:.1f}h"]
+    spans = {}
+    for (name, labels), span in self.spans.items():
+      if agent is not None and dict(labels).get('agent') != agent:
+        continue
+      merged = spans.setdefault(name, {"count": 0, "total": 0.0, "samples": []})
+      merged["count"] += span["count"]
+      merged["total"] += span["total"]
+      merged["samples"].extend(span["samples"])
+    for name, span in sorted(spans.items()):
+      lines.append(f"{name:<12} n={span['count']:<6} mean={span['total'] / span['count'] * 1000:.0f}ms "
+                   f"p50={_percentile(span['samples'], 50) * 1000:.0f}ms p95={_percentile(span['samples'], 95) * 1000:.0f}ms")
+
+    per_agent = {}
+    for (name, labels), value in self.counters.items():
+      labels = dict(labels)
+      if 'agent' not in labels or (agent is not None and labels['agent'] != agent):
+        continue
+      stats = per_agent.setdefault(labels.pop('agent'), {})
+      column = ":".join([name] + [label for _, label in sorted(labels.items())])
+      stats[column] = stats.get(column, 0) + value
+    for name, stats in sorted(per_agent.items()):
+      lines.append(f"{name}: " + ", ".join(f"{column}={value:g}" for column, value in sorted(stats.items())))
+
+    if agent is None:
+      for name in ("debounce_resets", "turns_cancelled", "turn_errors", "round_errors", "failovers", "worker_failures", "worker_failovers", "consolidation_coalesced", "consolidation_errors"):
+        total = sum(value for (counter, _), value in self.counters.items() if counter == name)
+        if total:
+          lines.append(f"{name}={total:g}")
+      for name, values in self._collected().items():
+        if values:
+          lines.append(f"{name}: " + ", ".join(f"{k}={v:.3g}" if isinstance(v, float) else f"{k}={v}" for k, v in values.items()))
+    return "\n".join(lines)
+
+
+  def prometheus(self):
+    lines = []
+    def label_text(labels):
+      return "{" + ",".join(f'{k}="{v}"' for k, v in labels) + "}" if labels else ""
+
+    for (name, labels), value in sorted(self.counters.items()):
+      lines.append(f"agents_{name}_total{label_text(labels)} {value}")
+    for (name, labels), span in sorted(self.spans.items(), key=lambda item: item[0]):
+      for quantile in (0.5, 0.95):
+        quantile_labels = labels + (("quantile", str(quantile)),)
+        lines.append(f"agents_{name}_seconds{label_text(quantile_labels)} {_percentile(span['samples'], quantile * 100):.6f}")
+      lines.append(f"agents_{name}_seconds_sum{label_text(labels)} {span['total']:.6f}")
+      lines.append(f"agents_{name}_seconds_count{label_text(labels)} {span['count']}")
+    for collector, values in self._collected().items():
+      for key, value in values.items():
+        lines.append(f"agents_{collector}_{key} {value}")
+    return "\n".join(lines) + "\n"
+
+
+  async def serve(self, port, host='127.0.0.1'):
+    # just enough http for a prometheus scrape; every path returns the metrics
+    async def handle(reader, writer):
+      try:
+        await reader.readuntil(b"\r\n\r\n")
+        body = self.prometheus().encode('utf-8')
+        writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                     + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode('ascii') + body)
+        await writer.drain()
+      except (asyncio.IncompleteReadError, ConnectionError):
+        pass
+      finally:
+        writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    print(f"metrics on http://{host}:{port}/metrics")
+    async with server:
+      await server.serve_forever()
+
+
+  def _write_json(self, path, summary):
+    directory = os.path.dirname(path) or '.'
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.metrics-')
+    with os.fdopen(fd, 'w') as file:
+      json.dump(summary, file, indent=1)
+    os.replace(tmp_path, path)
+
+
+  async def dump(self, path, interval=60):
+    while True:
+      await asyncio.sleep(interval)
+      await asyncio.to_thread(self._write_json, path, self.summary())
+
+
+  def start(self):
+    # background exporters configured from the environment
+    tasks = []
+    if os.getenv('METRICS_PORT'):
+      tasks.append(asyncio.create_task(self.serve(int(os.getenv('METRICS_PORT')), os.getenv('METRICS_HOST', '127.0.0.1'))))
+    if os.getenv('METRICS_DUMP_PATH'):
+      tasks.append(asyncio.create_task(self.dump(os.getenv('METRICS_DUMP_PATH'), float(os.getenv('METRICS_DUMP_INTERVAL', 60)))))
+    return tasks
+
+
+metrics = Metrics()
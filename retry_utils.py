@@ -0,0 +1,134 @@
+import time
+import random
+import asyncio
+from datetime import datetime
+
+# request pipeline for provider calls: per-attempt timeout, jittered
+# exponential backoff on retryable errors, and a limiter that tracks the
+# remaining request/token budget the provider reports in response headers.
+
+RETRYABLE_STATUS = {408, 409, 429, 500, 502, 503, 504, 529}
+
+
+def is_retryable(e):
+  if isinstance(e, asyncio.TimeoutError):
+    return True
+  # both SDKs use these names, no need to import either to check
+  if any(cls.__name__ in ('APITimeoutError', 'APIConnectionError') for cls in type(e).__mro__):
+    return True
+  return getattr(e, 'status_code', None) in RETRYABLE_STATUS
+
+
+def _parse_reset(value):
+  # anthropic sends RFC 3339 timestamps, openai sends durations like "6m0s" / "250ms"
+  if not value:
+    return None
+  try:
+    return datetime.fromisoformat(value.replace('Z', '+00:00')).timestamp()
+  except ValueError:
+    pass
+  seconds = 0.0
+  number = ''
+  i = 0
+  while i < len(value):
+    c = value[i]
+    if c.isdigit() or c == '.':
+      number += c
+    elif value.startswith('ms', i):
+      seconds += float(number or 0) / 1000
+      number = ''
+      i += 1
+    elif c in 'hms':
+      seconds += float(number or 0) * {'h': 3600, 'm': 60, 's': 1}[c]
+      number = ''
+    else:
+      return None
+    i += 1
+  return time.time() + seconds
+
+
+class RateLimiter:
+  # header-driven token bucket: remaining counts come from the provider and
+  # are spent locally between responses, refilling at the reported reset time
+  def __init__(self, name, header_names):
+    self.name = name
+    self.header_names = header_names  # bucket -> (remaining header, reset header)
+    self.remaining = {}
+    self.reset_at = {}
+    self.blocked_until = 0
+    self.waits = 0
+
+
+  async def acquire(self, tokens=0):
+    while True:
+      now = time.time()
+      wait = max(0, self.blocked_until - now)
+      for bucket, cost in (('requests', 1), ('tokens', tokens)):
+        remaining = self.remaining.get(bucket)
+        reset_at = self.reset_at.get(bucket)
+        if remaining is None or reset_at is None:
+          continue
+        if reset_at <= now:
+          # window rolled over; trust the provider again until told otherwise
+          del self.remaining[bucket]
+        elif remaining < cost:
+          wait = max(wait, reset_at - now)
+      if wait <= 0:
+        break
+      self.waits += 1
+      await asyncio.sleep(wait)
+
+    for bucket, cost in (('requests', 1), ('tokens', tokens)):
+      if bucket in self.remaining:
+        self.remaining[bucket] -= cost
+
+
+  def update(self, headers):
+    for bucket, (remaining_header, reset_header) in self.header_names.items():
+      remaining = headers.get(remaining_header)
+      if remaining is not None:
+        self.remaining[bucket] = int(remaining)
+        self.reset_at[bucket] = _parse_reset(headers.get(reset_header))
+
+
+  def block(self, seconds):
+    self.blocked_until = max(self.blocked_until, time.time() + seconds)
+
+
+anthropic_limiter = RateLimiter('anthropic', {
+  'requests': ('anthropic-ratelimit-requests-remaining', 'anthropic-ratelimit-requests-reset'),
+  'tokens': ('anthropic-ratelimit-tokens-remaining', 'anthropic-ratelimit-tokens-reset'),
+})
+openai_limiter = RateLimiter('openai', {
+  'requests': ('x-ratelimit-remaining-requests', 'x-ratelimit-reset-requests'),
+  'tokens': ('x-ratelimit-remaining-tokens', 'x-ratelimit-reset-tokens'),
+})
+
+
+async def with_retries(call, limiter, tokens=0, attempts=4, timeout=60, base_delay=1, max_delay=30):
+  # call() must return the sdk's raw response (.headers, and a synchronous
+  # .parse()); returns the parsed result
+  for attempt in range(attempts):
+    await limiter.acquire(tokens)
+    try:
+      raw = await asyncio.wait_for(call(), timeout)
+      limiter.update(raw.headers)
+      return raw.parse()
+    except Exception as e:
+      response = getattr(e, 'response', None)
+      if response is not None:
+        limiter.update(response.headers)
+      if not is_retryable(e) or attempt == attempts - 1:
+        raise
+
+      delay = min(max_delay, base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+      retry_after = response.headers.get('retry-after') if response is not None else None
+      if retry_after:
+        try:
+          delay = max(delay, float(retry_after))
+        except ValueError:
+          pass
+      if getattr(e, 'status_code', None) == 429:
+        limiter.block(delay)
+      print(f"{limiter.name} request failed ({e.__class__.__name__}), retry {attempt + 1}/{attempts - 1} in {delay:.1f}s")
+      await asyncio.sleep(delay)
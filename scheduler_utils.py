@@ -0,0 +1,121 @@
+import os
+import time
+import heapq
+import random
+import asyncio
+
+from metrics_utils import metrics
+
+# when a channel's next turn runs, and in which order its agents go. the
+# debounce follows the channel's own message rate instead of a fixed 4s, and
+# a busy channel still gets a turn within max_wait of the first unanswered
+# message, however fast new ones keep coming.
+
+MIN_DEBOUNCE = float(os.getenv('TURN_MIN_DEBOUNCE', 1))
+MAX_DEBOUNCE = float(os.getenv('TURN_MAX_DEBOUNCE', 4))
+MAX_WAIT = float(os.getenv('TURN_MAX_WAIT', 8))
+MIN_TURN_GAP = float(os.getenv('TURN_MIN_GAP', 3))
+
+
+class TurnScheduler:
+  def __init__(self, min_debounce=MIN_DEBOUNCE, max_debounce=MAX_DEBOUNCE, max_wait=MAX_WAIT, min_gap=MIN_TURN_GAP, smoothing=0.3):
+    self.min_debounce = min_debounce
+    self.max_debounce = max_debounce
+    self.max_wait = max_wait
+    self.min_gap = min_gap
+    self.smoothing = smoothing
+    # moving average of the gap between messages; starts out assuming a quiet channel
+    self.mean_gap = max_debounce
+    self.last_message_at = None
+    self.first_pending_at = None
+    self.pending = None
+    self.last_turn_at = 0
+
+
+  def debounce(self):
+    # wait about two typical gaps for a burst to finish
+    return min(self.max_debounce, max(self.min_debounce, 2 * self.mean_gap))
+
+
+  def note_message(self, message):
+    now = time.time()
+    if self.last_message_at is not None:
+      gap = now - self.last_message_at
+      self.mean_gap += self.smoothing * (gap - self.mean_gap)
+    self.last_message_at = now
+    if self.pending is None:
+      self.first_pending_at = now
+    else:
+      metrics.incr('debounce_resets')
+    self.pending = message
+
+
+  def due_at(self):
+    due = min(self.last_message_at + self.debounce(), self.first_pending_at + self.max_wait)
+    return max(due, self.last_turn_at + self.min_gap)
+
+
+  async def next_turn(self):
+    # returns the newest message once it's time to answer, or None if nothing is pending.
+    # new messages move the due time, so it's recomputed after every sleep
+    while self.pending is not None:
+      delay = self.due_at() - time.time()
+      if delay <= 0:
+        message, self.pending = self.pending, None
+        self.last_turn_at = time.time()
+        return message
+      await asyncio.sleep(delay)
+    return None
+
+
+  def prioritize(self, agents, mentioned_agents, last_response):
+    # mentioned agents first, then whoever has gone longest without speaking;
+    # random tie-break so equally idle agents don't always go in roster order
+    queue = [
+      (agent not in mentioned_agents, last_response.get(agent.name, 0), random.random(), i)
+      for i, agent in enumerate(agents)
+    ]
+    heapq.heapify(queue)
+    return [agents[heapq.heappop(queue)[-1]] for _ in range(len(queue))]
+
+
+class TokenBudget:
+  # per-agent token bucket that refills continuously. spend is read from the
+  # token counters the llm layer already records, so every call is charged
+  # what the provider actually reported. cache reads are billed at a tenth of
+  # input and cache writes at 1.25x, so they count that way here too
+  WEIGHTS = {'input': 1, 'output': 1, 'cache_read': 0.1, 'cache_write': 1.25}
+
+  def __init__(self, tokens_per_hour=0):
+    self.capacity = tokens_per_hour
+    self.rate = tokens_per_hour / 3600
+    self.buckets = {}  # agent -> (level, updated_at, spend seen so far)
+
+
+  def _spent(self, agent):
+    return sum(metrics.get('tokens', agent=agent, kind=kind) * weight for kind, weight in self.WEIGHTS.items())
+
+
+  def remaining(self, agent):
+    if not self.capacity:
+      return None
+    now = time.time()
+    spent = self._spent(agent)
+    level, updated_at, seen = self.buckets.get(agent, (self.capacity, now, spent))
+    level = min(self.capacity, level + (now - updated_at) * self.rate) - (spent - seen)
+    self.buckets[agent] = (level, now, spent)
+    return level
+
+
+  def allow(self, agent):
+    # an agent can overdraw by one completion, then sits out until it refills
+    remaining = self.remaining(agent)
+    return remaining is None or remaining > 0
+
+
+  def stats(self):
+    return {agent: self.remaining(agent) for agent in self.buckets}
+
+
+# AGENT_TOKEN_BUDGET is tokens per agent per hour, shared across channels; 0 means no limit
+token_budget = TokenBudget(int(os.getenv('AGENT_TOKEN_BUDGET', 0)))
@@ -0,0 +1,456 @@
+import os
+import sys
+import json
+import time
+import asyncio
+import hmac
+import hashlib
+import itertools
+
+from agent_utils import Agent, valid_agent_name
+from guild_utils import GuildIndex
+from consolidation_utils import ConsolidationWorker
+from llm_utils import REQUEST_TIMEOUT
+from metrics_utils import metrics, current_agent, usage_sink
+
+# gateway/worker split. the gateway process keeps the discord connection,
+# history, gates and posting; agent workers own the Agent instances and do the
+# context building and completions. agents are sharded across workers by name
+# and every call is one json message over a unix socket (or tcp, for workers
+# on other machines), with in-process workers as a stand-in for tests and
+# single-box setups.
+#
+# the gateway owns rosters, vips and prompts and sends workers what they need;
+# an agent's memories belong to whichever worker currently owns it.
+
+# newline-delimited json; a 50 message history snapshot fits many times over
+MAX_FRAME = 16 * 1024 * 1024
+PING_TIMEOUT = 5
+# assign/release/guild: loading agents or flushing state, never a completion
+CONTROL_TIMEOUT = 30
+# a connection that hasn't said hello by then is dropped
+HELLO_TIMEOUT = 10
+# longest a decision may take on a worker: up to 4 attempts with backoff on
+# claude, then the same again on the openai failover. past this a worker is
+# treated as gone, which also catches tcp peers that vanished without a reset
+WORKER_TIMEOUT = float(os.getenv('WORKER_TIMEOUT', 2 * (4 * REQUEST_TIMEOUT + 90) + 60))
+# a worker that's down is pinged again after this long, doubling up to the max
+RETRY_MIN = 1
+RETRY_MAX = 60
+
+
+class WorkerError(Exception):
+  # a worker got the request but failed handling it
+  pass
+
+
+class ShardState:
+  # a worker's view of the bot's state: prompts and vips as last sent by the
+  # gateway, everything else from the real store
+  def __init__(self, state):
+    self.state = state
+    self.prompts = {}
+    self.current_vips = []
+
+
+  def prompt(self, agent):
+    return self.prompts.get(agent)
+
+
+  def vips(self):
+    return list(self.current_vips)
+
+
+  def __getattr__(self, name):
+    return getattr(self.state, name)
+
+
+class AgentWorker:
+  # stands in for the bot as far as Agent is concerned: state, guild_index
+  # and consolidator. standalone workers run in their own process and reload
+  # an agent's memories when they take it over
+  def __init__(self, state, standalone=False):
+    self.state = ShardState(state)
+    self.standalone = standalone
+    self.guild_index = GuildIndex()
+    self.consolidator = ConsolidationWorker(self.state)
+    self.consolidation_task = None
+    self.agents = {}
+
+
+  async def handle(self, request):
+    op = request['op']
+    if op == 'ping':
+      return sorted(self.agents)
+    if op == 'assign':
+      bad = [name for name in request['agents'] if not valid_agent_name(name)]
+      if bad:
+        raise ValueError(f"invalid agent names: {bad}")
+      if self.consolidation_task is None:
+        self.consolidation_task = asyncio.create_task(self.consolidator.run())
+      for name, prompt in request['agents'].items():
+        self.state.prompts[name] = prompt
+        if name not in self.agents:
+          if self.standalone:
+            self.state.forget(name)
+          self.agents[name] = Agent(name, self)
+      return sorted(self.agents)
+    if op == 'release':
+      for name in request['agents']:
+        self.agents.pop(name, None)
+        self.state.prompts.pop(name, None)
+      # the next owner reads whatever we've written so far
+      await self.state.flush()
+      return sorted(self.agents)
+    if op == 'guild':
+      self.guild_index.names_by_id = request['names_by_id']
+      self.guild_index.version = request['version']
+      return self.guild_index.version
+    if op == 'decide':
+      return await self.decide(request['agent'], request['messages'], request['vips'])
+    raise ValueError(f"unknown op {op!r}")
+
+
+  async def decide(self, name, messages, vips):
+    agent = self.agents.get(name)
+    if agent is None:
+      # restarted since the gateway placed it here
+      return {"missing": True}
+    self.state.current_vips = vips
+    current_agent.set(name)
+    tokens = {}
+    usage_sink.set(tokens)
+    agent.messages = messages
+    response = await agent.respond_async()
+    return {"response": response, "tokens": tokens}
+
+
+class LocalTransport:
+  # in-process worker: same messages, no socket. each call runs as its own
+  # task so the worker's context vars stay out of the caller's
+  remote = False
+
+  def __init__(self, worker, name):
+    self.worker = worker
+    self.name = name
+
+
+  async def call(self, request):
+    # round-trip through json so nothing works here that wouldn't over the wire
+    return await asyncio.create_task(self.worker.handle(json.loads(json.dumps(request))))
+
+
+  def close(self):
+    pass
+
+
+async def _open(address):
+  if '/' not in address and ':' in address:
+    host, port = address.rsplit(':', 1)
+    return await asyncio.open_connection(host, int(port), limit=MAX_FRAME)
+  return await asyncio.open_unix_connection(address, limit=MAX_FRAME)
+
+
+class SocketTransport:
+  # one persistent connection per worker, requests multiplexed by id. a lost
+  # connection fails everything in flight and the next call reconnects
+  remote = True
+
+  def __init__(self, address, secret):
+    self.name = address
+    self.address = address
+    self.secret = secret
+    self.writer = None
+    self.read_task = None
+    self.pending = {}
+    self.ids = itertools.count()
+    self.lock = asyncio.Lock()
+
+
+  async def _connect(self):
+    async with self.lock:
+      if self.writer is None:
+        reader, self.writer = await _open(self.address)
+        # first line on every connection; the worker hangs up on a wrong secret
+        self.writer.write(json.dumps({"op": "hello", "secret": self.secret}).encode('utf-8') + b"\n")
+        self.read_task = asyncio.create_task(self._read_replies(reader, self.writer))
+
+
+  async def _read_replies(self, reader, writer):
+    try:
+      while line := await reader.readline():
+        reply = json.loads(line)
+        future = self.pending.pop(reply['id'], None)
+        if future is None or future.done():
+          continue  # the caller gave up on it
+        if 'error' in reply:
+          future.set_exception(WorkerError(reply['error']))
+        else:
+          future.set_result(reply['result'])
+    except (OSError, ValueError) as e:
+      print(f"worker {self.address}: {e}")
+    finally:
+      if self.writer is writer:
+        self.writer = None
+      writer.close()
+      for future in self.pending.values():
+        if not future.done():
+          future.set_exception(ConnectionError(f"worker {self.address} disconnected"))
+      self.pending.clear()
+
+
+  async def call(self, request):
+    await self._connect()
+    id = next(self.ids)
+    future = asyncio.get_running_loop().create_future()
+    self.pending[id] = future
+    try:
+      self.writer.write(json.dumps({**request, "id": id}).encode('utf-8') + b"\n")
+      await self.writer.drain()
+      return await future
+    finally:
+      self.pending.pop(id, None)
+
+
+  def close(self):
+    # drops the connection; whatever's in flight fails and the next call reconnects
+    if self.writer is not None:
+      self.writer.close()
+
+
+class ShardRouter:
+  def __init__(self, transports, state):
+    self.transports = {transport.name: transport for transport in transports}
+    self.live = list(self.transports)
+    self.down = {}  # worker -> (when to ping it next, current backoff)
+    self.state = state
+    self.agents = set()  # everything that should be placed somewhere
+    self.assigned = {}  # agent -> worker it's been handed to
+    self.guild_versions = {}  # worker -> guild index version it has
+    self.lock = asyncio.Lock()
+    self.moves = 0
+
+
+  def owner(self, agent):
+    # rendezvous hashing: every agent goes to its highest scoring live worker,
+    # so losing a worker only moves the agents that were on it
+    return max(self.live, key=lambda worker: hashlib.sha1(f"{worker}:{agent}".encode('utf-8')).digest())
+
+
+  async def rebalance(self, agents=None):
+    # places every rostered agent on its owner and drops the rest; called at
+    # startup, on !add/!kill and when a worker goes away
+    async with self.lock:
+      if agents is not None:
+        self.agents = set(agents)
+      await self._revive()
+      while True:
+        if not self.live:
+          if not self.agents:
+            return
+          raise ConnectionError("no agent workers are up")
+        wanted = {agent: self.owner(agent) for agent in self.agents}
+        releases, assigns = {}, {}
+        for agent, worker in list(self.assigned.items()):
+          if wanted.get(agent) != worker:
+            releases.setdefault(worker, []).append(agent)
+            del self.assigned[agent]
+        for agent, worker in wanted.items():
+          if agent not in self.assigned:
+            assigns.setdefault(worker, {})[agent] = self.state.prompt(agent)
+
+        # the old owner flushes before the new one loads the agent's memories.
+        # a release that fails is fine: that worker is gone or restarted empty
+        await asyncio.gather(*(
+          asyncio.wait_for(self.transports[worker].call({"op": "release", "agents": names}), CONTROL_TIMEOUT)
+          for worker, names in releases.items()
+        ), return_exceptions=True)
+        results = await asyncio.gather(*(
+          asyncio.wait_for(self.transports[worker].call({"op": "assign", "agents": prompts}), CONTROL_TIMEOUT)
+          for worker, prompts in assigns.items()
+        ), return_exceptions=True)
+
+        failed = False
+        for (worker, prompts), result in zip(assigns.items(), results):
+          if isinstance(result, Exception):
+            self._mark_down(worker, result)
+            failed = True
+          else:
+            self.assigned.update((agent, worker) for agent in prompts)
+            self.moves += len(prompts)
+        if not failed:
+          return
+
+
+  def _mark_down(self, worker, error):
+    # its agents move to the others until it answers a ping again
+    if worker in self.live:
+      print(f"worker {worker} is down: {error!r}")
+      metrics.incr('worker_failures', worker=worker)
+      self.live.remove(worker)
+      self.down[worker] = (time.time() + RETRY_MIN, RETRY_MIN)
+    self.transports[worker].close()
+    self.guild_versions.pop(worker, None)
+    for agent in [agent for agent, owner in self.assigned.items() if owner == worker]:
+      del self.assigned[agent]
+
+
+  def _retry_due(self):
+    now = time.time()
+    return [worker for worker, (retry_at, _) in self.down.items() if retry_at <= now]
+
+
+  async def _revive(self):
+    # pings the down workers whose backoff is up; the ones that answer are
+    # live again and get their agents back on this rebalance
+    due = self._retry_due()
+    for worker in due:
+      # pushed back first so concurrent callers don't ping it too
+      backoff = min(self.down[worker][1] * 2, RETRY_MAX)
+      self.down[worker] = (time.time() + backoff, backoff)
+    results = await asyncio.gather(*(
+      asyncio.wait_for(self.transports[worker].call({"op": "ping"}), PING_TIMEOUT) for worker in due
+    ), return_exceptions=True)
+    for worker, result in zip(due, results):
+      if isinstance(result, Exception):
+        self.transports[worker].close()
+      else:
+        print(f"worker {worker} is back")
+        del self.down[worker]
+        self.live.append(worker)
+
+
+  async def _lost(self, worker):
+    # the connection dropped or the worker restarted and lost its agents:
+    # re-place them, on the same worker if it still answers
+    self.guild_versions.pop(worker, None)
+    for agent in [agent for agent, owner in self.assigned.items() if owner == worker]:
+      del self.assigned[agent]
+    if worker in self.live:
+      try:
+        await asyncio.wait_for(self.transports[worker].call({"op": "ping"}), PING_TIMEOUT)
+      except (OSError, asyncio.TimeoutError) as e:
+        self._mark_down(worker, e)
+    await self.rebalance()
+
+
+  async def _sync_guild(self, worker, guild_index):
+    # workers format mentions from the same names the gateway sees
+    if self.guild_versions.get(worker) != guild_index.version:
+      version = guild_index.version
+      request = {"op": "guild", "version": version, "names_by_id": guild_index.names_by_id}
+      await asyncio.wait_for(self.transports[worker].call(request), CONTROL_TIMEOUT)
+      self.guild_versions[worker] = version
+
+
+  async def decide(self, agent, messages, vips, guild_index):
+    for _ in range(len(self.transports) + 1):
+      if agent not in self.assigned or self._retry_due():
+        # not placed yet, its worker just went away, or a down worker is
+        # due a ping. the next rebalance drops it again if nobody rosters it
+        await self.rebalance(self.agents | {agent})
+      worker = self.assigned[agent]
+      transport = self.transports[worker]
+      try:
+        await self._sync_guild(worker, guild_index)
+        request = {"op": "decide", "agent": agent, "messages": messages, "vips": vips}
+        result = await asyncio.wait_for(transport.call(request), WORKER_TIMEOUT)
+      except (OSError, asyncio.TimeoutError):
+        metrics.incr('worker_failovers', agent=agent)
+        await self._lost(worker)
+        continue
+      if result.get('missing'):
+        await self._lost(worker)
+        continue
+      if transport.remote:
+        # the worker's llm calls were counted over there; budgets live here
+        for kind, tokens in result['tokens'].items():
+          metrics.incr('tokens', tokens, agent=agent, kind=kind)
+      return result['response']
+    raise ConnectionError(f"{agent}: no worker could take it")
+
+
+  def stats(self):
+    return {"workers": len(self.live), "workers_down": len(self.down), "agents": len(self.assigned), "moves": self.moves}
+
+
+def make_router(state):
+  # AGENT_WORKERS is a comma separated list of worker addresses (unix socket
+  # paths, or host:port); AGENT_SHARDS=n runs n workers in this process
+  # instead. neither means agents run inline on the gateway, as before
+  addresses = [address.strip() for address in os.getenv('AGENT_WORKERS', '').split(',') if address.strip()]
+  if addresses:
+    secret = os.getenv('WORKER_SECRET')
+    if not secret:
+      raise ValueError("AGENT_WORKERS needs WORKER_SECRET, the same one the workers have")
+    return ShardRouter([SocketTransport(address, secret) for address in addresses], state)
+  shards = int(os.getenv('AGENT_SHARDS', 0))
+  if shards:
+    return ShardRouter([LocalTransport(AgentWorker(state), f"local-{i}") for i in range(shards)], state)
+  return None
+
+
+async def serve(address, state, secret):
+  # anyone who gets a request through can spend the api keys, so every
+  # connection has to open with the shared secret
+  worker = AgentWorker(state, standalone=True)
+
+  async def authenticate(reader):
+    try:
+      hello = json.loads(await asyncio.wait_for(reader.readline(), HELLO_TIMEOUT))
+    except (asyncio.TimeoutError, OSError, ValueError):
+      return False
+    return (isinstance(hello, dict) and hello.get('op') == 'hello' and isinstance(hello.get('secret'), str)
+            and hmac.compare_digest(hello['secret'].encode('utf-8'), secret.encode('utf-8')))
+
+  async def on_connection(reader, writer):
+    if not await authenticate(reader):
+      print(f"rejected a connection from {writer.get_extra_info('peername') or 'a local client'}")
+      writer.close()
+      return
+    tasks = set()
+
+    async def reply(request):
+      try:
+        payload = {"result": await worker.handle(request)}
+      except Exception as e:
+        payload = {"error": f"{type(e).__name__}: {e}"}
+      writer.write(json.dumps({"id": request['id'], **payload}).encode('utf-8') + b"\n")
+
+    try:
+      while line := await reader.readline():
+        task = asyncio.create_task(reply(json.loads(line)))
+        tasks.add(task)
+        task.add_done_callback(tasks.discard)
+    except (OSError, ValueError) as e:
+      print(f"gateway connection: {e}")
+    finally:
+      for task in tasks:
+        task.cancel()
+      writer.close()
+
+  if '/' not in address and ':' in address:
+    host, port = address.rsplit(':', 1)
+    server = await asyncio.start_server(on_connection, host, int(port), limit=MAX_FRAME)
+  else:
+    if os.path.exists(address):
+      os.unlink(address)
+    server = await asyncio.start_unix_server(on_connection, address, limit=MAX_FRAME)
+    os.chmod(address, 0o600)
+  metrics.start()
+  print(f"agent worker on {address}")
+  async with server:
+    await server.serve_forever()
+
+
+if __name__ == '__main__':
+  # one agent worker: python -m shard_utils /tmp/agents-0.sock (or host:port).
+  # tcp workers should listen on a private interface only
+  from dotenv import load_dotenv
+  from state_utils import make_state
+  load_dotenv()
+  if len(sys.argv) != 2:
+    sys.exit("usage: python -m shard_utils <socket path or host:port>")
+  if not os.getenv('WORKER_SECRET'):
+    sys.exit("set WORKER_SECRET (the gateway needs the same one)")
+  asyncio.run(serve(sys.argv[1], make_state(int(os.getenv('GENERAL_CHANNEL_ID', 0))), os.getenv('WORKER_SECRET')))
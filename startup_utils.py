@@ -0,0 +1,27 @@
+import time
+from contextlib import contextmanager
+
+# wall-clock cost of imports and lazy initialization, by component. anything
+# timed after startup (first client use, model load) shows up here too.
+
+LAUNCH_TIME = time.perf_counter()
+timings = {}
+
+
+@contextmanager
+def timed(component):
+  start = time.perf_counter()
+  try:
+    yield
+  finally:
+    timings[component] = timings.get(component, 0) + time.perf_counter() - start
+
+
+def mark(component):
+  # time from launch until now, e.g. for "gateway ready"
+  timings[component] = time.perf_counter() - LAUNCH_TIME
+
+
+def startup_report():
+  lines = [f"  {component:<24} {seconds * 1000:9.1f} ms" for component, seconds in timings.items()]
+  return "startup:\n" + "\n".join(lines)
@@ -0,0 +1,441 @@
+import os
+import sys
+import time
+import queue
+import asyncio
+import sqlite3
+import tempfile
+import threading
+import numpy as np
+from contextlib import contextmanager
+
+from config_utils import config
+from memory_utils import MemoryStore, EMBEDDING_DIM
+
+# agent state: channel rosters, vips, prompts, scratch and long-term memories.
+# FileState is the original layout (text files under configs/ and agents/);
+# SQLiteState keeps all of it in one WAL database. reads come from memory,
+# writes are applied in memory right away and committed in batches by a
+# writer thread, so the event loop never waits on disk.
+
+# seconds a connection waits on another process's lock before erroring
+BUSY_TIMEOUT = 30
+
+
+class FileState:
+  def __init__(self, general_channel_id, agents_dir='agents', configs_dir='configs'):
+    self.general_channel_id = general_channel_id
+    self.agents_dir = agents_dir
+    self.configs_dir = configs_dir
+    self._memory_stores = {}
+    # scratch is rewritten off the event loop; appends wait for a rewrite to land
+    self._scratch_lock = threading.Lock()
+
+
+  def roster_file(self, channel_id):
+    if channel_id == self.general_channel_id:
+      return f'{self.configs_dir}/online_agents.txt'
+    return f'{self.configs_dir}/online_agents_{channel_id}.txt'
+
+
+  def roster(self, channel_id):
+    # None when the channel has never had one
+    if config.read(self.roster_file(channel_id)) is None:
+      return None
+    return config.lines(self.roster_file(channel_id))
+
+
+  async def set_roster(self, channel_id, names):
+    await config.write_lines(self.roster_file(channel_id), names)
+
+
+  def vips(self):
+    return config.lines(f'{self.configs_dir}/vips.txt')
+
+
+  async def set_vips(self, names):
+    await config.write_lines(f'{self.configs_dir}/vips.txt', names)
+
+
+  def agent_names(self):
+    if not os.path.isdir(self.agents_dir):
+      return []
+    return [f for f in os.listdir(self.agents_dir) if os.path.isdir(os.path.join(self.agents_dir, f))]
+
+
+  def prompt(self, agent):
+    return config.read(f'{self.agents_dir}/{agent}/prompt.txt')
+
+
+  async def set_prompt(self, agent, text):
+    os.makedirs(f'{self.agents_dir}/{agent}/memory', exist_ok=True)
+    await config.write(f'{self.agents_dir}/{agent}/prompt.txt', text)
+
+
+  def _scratch_file(self, agent):
+    return f'{self.agents_dir}/{agent}/memory/scratch.txt'
+
+
+  def scratch(self, agent):
+    try:
+      with open(self._scratch_file(agent), 'r') as file:
+        return [line.rstrip('\n') for line in file if line.strip()]
+    except FileNotFoundError:
+      return []
+
+
+  def add_scratch(self, agent, text):
+    os.makedirs(os.path.dirname(self._scratch_file(agent)), exist_ok=True)
+    with self._scratch_lock, open(self._scratch_file(agent), 'a') as file:
+      file.write(f"{text}\n")
+
+
+  def clear_scratch(self, agent, count=None):
+    # drops the oldest count lines (all of them by default); anything added
+    # after they were read stays
+    path = self._scratch_file(agent)
+    with self._scratch_lock:
+      if not os.path.exists(path):
+        return
+      remaining = self.scratch(agent)[count:] if count is not None else []
+      fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+      with os.fdopen(fd, 'w') as file:
+        file.writelines(f"{line}\n" for line in remaining)
+      os.replace(tmp_path, path)
+
+
+  def memory_store(self, agent):
+    # one per agent, shared by every channel it's in
+    if agent not in self._memory_stores:
+      self._memory_stores[agent] = MemoryStore(f'{self.agents_dir}/{agent}/memory')
+    return self._memory_stores[agent]
+
+
+  async def publish_memory(self, agent, text, embedding, scratch_count):
+    # a consolidated memory and the scratch it came from. two files can't
+    # change atomically, so the memory goes first: a crash in between repeats
+    # a summary rather than losing one. both are disk writes, kept off the loop
+    def publish():
+      self.memory_store(agent).add(text, embedding)
+      self.clear_scratch(agent, scratch_count)
+    await asyncio.to_thread(publish)
+
+
+  def forget(self, agent):
+    # another process may have written this agent's memories; reload on next use
+    self._memory_stores.pop(agent, None)
+
+
+  async def flush(self):
+    pass
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rosters (channel INTEGER, position INTEGER, agent TEXT, PRIMARY KEY (channel, position));
+CREATE TABLE IF NOT EXISTS vips (name TEXT PRIMARY KEY, position INTEGER);
+CREATE TABLE IF NOT EXISTS prompts (agent TEXT PRIMARY KEY, text TEXT, updated_at REAL);
+CREATE TABLE IF NOT EXISTS scratch (id INTEGER PRIMARY KEY, agent TEXT, text TEXT, created_at REAL);
+CREATE INDEX IF NOT EXISTS scratch_agent ON scratch (agent, id);
+CREATE TABLE IF NOT EXISTS memories (id INTEGER PRIMARY KEY, agent TEXT, text TEXT, time TEXT, embedding BLOB);
+CREATE INDEX IF NOT EXISTS memories_agent ON memories (agent, id);
+"""
+
+
+class SQLiteState:
+  def __init__(self, path, max_batch=500):
+    self.path = path
+    self.max_batch = max_batch
+    db = self._connect()
+    db.executescript(SCHEMA)
+    db.commit()
+    # readers get their own connection; WAL lets them run alongside the writer
+    self._read_db = db
+    self._read_lock = threading.Lock()
+    self._load()
+    self._memory_stores = {}
+    self._queue = queue.Queue()
+    self._batch = None
+    self.commits = 0
+    self.writes = 0
+    self.retries = 0
+    self.dropped = 0
+    self._writer = threading.Thread(target=self._write_loop, name='state-writer', daemon=True)
+    self._writer.start()
+
+
+  def _connect(self):
+    # gateway and agent workers can share one db; wait out each other's commits
+    db = sqlite3.connect(self.path, timeout=BUSY_TIMEOUT, check_same_thread=False)
+    db.execute("PRAGMA journal_mode=WAL")
+    # WAL + NORMAL only risks the last few commits on power loss, never corruption
+    db.execute("PRAGMA synchronous=NORMAL")
+    return db
+
+
+  def _load(self):
+    # small tables are mirrored in memory; memories load per agent on first use
+    with self._read_lock:
+      db = self._read_db
+      self._rosters = {}
+      for channel, agent in db.execute("SELECT channel, agent FROM rosters ORDER BY channel, position"):
+        self._rosters.setdefault(channel, []).append(agent)
+      self._vips = [name for (name,) in db.execute("SELECT name FROM vips ORDER BY position")]
+      self._prompts = dict(db.execute("SELECT agent, text FROM prompts"))
+      self._scratch = {}
+      for agent, text in db.execute("SELECT agent, text FROM scratch ORDER BY id"):
+        self._scratch.setdefault(agent, []).append(text)
+
+
+  def _write_loop(self):
+    db = self._connect()
+    while True:
+      batch = [self._queue.get()]
+      # whatever else is already waiting goes into the same transaction
+      while len(batch) < self.max_batch:
+        try:
+          batch.append(self._queue.get_nowait())
+        except queue.Empty:
+          break
+      try:
+        self._commit(db, batch)
+      finally:
+        for _ in batch:
+          self._queue.task_done()
+
+
+  def _commit(self, db, batch):
+    # a busy or locked db is retried until it goes through. anything else
+    # would fail the same way every time: the writes in the batch are then
+    # committed one by one so only the bad one is lost
+    delay = 0.1
+    while True:
+      try:
+        with db:
+          for statements in batch:
+            for sql, params in statements:
+              db.execute(sql, params)
+        self.commits += 1
+        self.writes += len(batch)
+        return
+      except sqlite3.Error as e:
+        if isinstance(e, sqlite3.OperationalError) and ('locked' in str(e) or 'busy' in str(e)):
+          self.retries += 1
+          print(f"state: commit of {len(batch)} writes failed, retrying in {delay:.1f}s: {e}")
+          time.sleep(delay)
+          delay = min(delay * 2, 10)
+        elif len(batch) > 1:
+          for statements in batch:
+            self._commit(db, [statements])
+          return
+        else:
+          self.dropped += 1
+          print(f"state: dropping a write that can't be committed: {e}")
+          return
+
+
+  def _write(self, *statements):
+    # statements in one call commit together
+    if self._batch is not None:
+      self._batch.extend(statements)
+    else:
+      self._queue.put(statements)
+
+
+  @contextmanager
+  def _together(self):
+    # every _write inside commits as one transaction
+    self._batch = []
+    try:
+      yield
+    finally:
+      statements, self._batch = self._batch, None
+      if statements:
+        self._queue.put(tuple(statements))
+
+
+  async def flush(self):
+    # waits for everything queued so far to be committed
+    await asyncio.to_thread(self._queue.join)
+
+
+  def roster(self, channel_id):
+    roster = self._rosters.get(channel_id)
+    return list(roster) if roster is not None else None
+
+
+  async def set_roster(self, channel_id, names):
+    self._rosters[channel_id] = list(names)
+    self._write(
+      ("DELETE FROM rosters WHERE channel = ?", (channel_id,)),
+      *(("INSERT INTO rosters (channel, position, agent) VALUES (?, ?, ?)", (channel_id, i, name)) for i, name in enumerate(names)),
+    )
+
+
+  def vips(self):
+    return list(self._vips)
+
+
+  async def set_vips(self, names):
+    self._vips = list(names)
+    self._write(
+      ("DELETE FROM vips", ()),
+      *(("INSERT OR IGNORE INTO vips (name, position) VALUES (?, ?)", (name, i)) for i, name in enumerate(names)),
+    )
+
+
+  def agent_names(self):
+    return list(self._prompts)
+
+
+  def prompt(self, agent):
+    return self._prompts.get(agent)
+
+
+  async def set_prompt(self, agent, text):
+    self._prompts[agent] = text
+    self._write(("INSERT OR REPLACE INTO prompts (agent, text, updated_at) VALUES (?, ?, ?)", (agent, text, time.time())))
+
+
+  def scratch(self, agent):
+    return list(self._scratch.get(agent, []))
+
+
+  def add_scratch(self, agent, text):
+    self._scratch.setdefault(agent, []).append(text)
+    self._write(("INSERT INTO scratch (agent, text, created_at) VALUES (?, ?, ?)", (agent, text, time.time())))
+
+
+  def clear_scratch(self, agent, count=None):
+    if count is None:
+      self._scratch.pop(agent, None)
+      self._write(("DELETE FROM scratch WHERE agent = ?", (agent,)))
+      return
+    self._scratch[agent] = self._scratch.get(agent, [])[count:]
+    self._write(("DELETE FROM scratch WHERE id IN (SELECT id FROM scratch WHERE agent = ? ORDER BY id LIMIT ?)", (agent, count)))
+
+
+  def memory_store(self, agent):
+    if agent not in self._memory_stores:
+      self._memory_stores[agent] = SQLiteMemoryStore(self, agent)
+    return self._memory_stores[agent]
+
+
+  async def publish_memory(self, agent, text, embedding, scratch_count):
+    # the memory and the scratch trim land in one commit, so a crash can't
+    # keep one without the other
+    with self._together():
+      self.memory_store(agent).add(text, embedding)
+      self.clear_scratch(agent, scratch_count)
+
+
+  def forget(self, agent):
+    # another process may have written this agent's memories; reload on next use
+    self._memory_stores.pop(agent, None)
+    with self._read_lock:
+      lines = [text for (text,) in self._read_db.execute("SELECT text FROM scratch WHERE agent = ? ORDER BY id", (agent,))]
+    if lines:
+      self._scratch[agent] = lines
+    else:
+      self._scratch.pop(agent, None)
+
+
+  def stats(self):
+    return {"queued": self._queue.unfinished_tasks, "writes": self.writes, "commits": self.commits, "retries": self.retries, "dropped": self.dropped}
+
+
+class SQLiteMemoryStore(MemoryStore):
+  # same interface as MemoryStore; rows live in the memories table and the
+  # normalized matrix is kept in memory for search
+  def __init__(self, state, agent, dim=EMBEDDING_DIM):
+    self.state = state
+    self.agent = agent
+    self.dim = dim
+    self._memories = None
+    self._buffer = np.empty((0, dim), dtype=np.float32)
+    self._rows = 0
+
+
+  def _load(self):
+    if self._memories is not None:
+      return
+    with self.state._read_lock:
+      rows = self.state._read_db.execute("SELECT text, time, embedding FROM memories WHERE agent = ? ORDER BY id", (self.agent,)).fetchall()
+    self._memories = [{"time": timestamp, "text": text} for text, timestamp, _ in rows]
+    embeddings = np.frombuffer(b"".join(blob for _, _, blob in rows), dtype=np.float32).reshape(-1, self.dim)
+    self._buffer = embeddings.copy()
+    self._rows = len(embeddings)
+
+
+  def _append(self, records, embeddings):
+    # grow by doubling so a stream of single adds stays amortized O(1)
+    needed = self._rows + len(embeddings)
+    if needed > len(self._buffer):
+      buffer = np.empty((max(needed, 2 * len(self._buffer), 16), self.dim), dtype=np.float32)
+      buffer[:self._rows] = self._buffer[:self._rows]
+      self._buffer = buffer
+    self._buffer[self._rows:needed] = embeddings
+    self._rows = needed
+    self.state._write(*(
+      ("INSERT INTO memories (agent, text, time, embedding) VALUES (?, ?, ?, ?)",
+       (self.agent, record["text"], record["time"], np.ascontiguousarray(embedding, dtype=np.float32).tobytes()))
+      for record, embedding in zip(records, embeddings)
+    ))
+
+
+  def _get_matrix(self):
+    self._load()
+    return self._buffer[:self._rows]
+
+
+def make_state(general_channel_id):
+  path = os.getenv('STATE_DB')
+  if path:
+    return SQLiteState(path)
+  return FileState(general_channel_id)
+
+
+async def migrate(state, file_state):
+  # copies everything from the file layout into an empty SQLiteState
+  counts = {"rosters": 0, "vips": 0, "prompts": 0, "scratch": 0, "memories": 0}
+  configs_dir = file_state.configs_dir
+  if os.path.isdir(configs_dir):
+    for filename in sorted(os.listdir(configs_dir)):
+      if filename == 'online_agents.txt':
+        channel_id = file_state.general_channel_id
+      elif filename.startswith('online_agents_') and filename.endswith('.txt'):
+        channel_id = int(filename[len('online_agents_'):-len('.txt')])
+      else:
+        continue
+      await state.set_roster(channel_id, file_state.roster(channel_id))
+      counts["rosters"] += 1
+  await state.set_vips(file_state.vips())
+  counts["vips"] = len(file_state.vips())
+
+  for agent in file_state.agent_names():
+    prompt = file_state.prompt(agent)
+    if prompt is not None:
+      await state.set_prompt(agent, prompt)
+      counts["prompts"] += 1
+    for line in file_state.scratch(agent):
+      state.add_scratch(agent, line)
+      counts["scratch"] += 1
+    # MemoryStore also picks up the older memory.pkl/embeddings.npy layout
+    records, embeddings = file_state.memory_store(agent).records()
+    if records:
+      state.memory_store(agent).add_many([record["text"] for record in records], embeddings, [record["time"] for record in records])
+      counts["memories"] += len(records)
+  await state.flush()
+  return counts
+
+
+if __name__ == '__main__':
+  # one-shot migration: python -m state_utils [state.db]
+  from dotenv import load_dotenv
+  load_dotenv()
+  path = sys.argv[1] if len(sys.argv) > 1 else os.getenv('STATE_DB', 'state.db')
+  if os.path.exists(path):
+    sys.exit(f"{path} already exists, not migrating over it")
+  general_channel_id = int(os.getenv('GENERAL_CHANNEL_ID', 0))
+  counts = asyncio.run(migrate(SQLiteState(path), FileState(general_channel_id)))
+  print(f"migrated into {path}: {counts}")
+  print(f"set STATE_DB={path} to use it")